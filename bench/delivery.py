@@ -0,0 +1,131 @@
+# Offline checks of what reaches a chat when sends fail: every tweet is posted once and the chat's cursor ends
+# past it. Runs the pipeline against the fakes of e2e.py, each scenario in its own process since the bot's state
+# is global, and exits with 1 if a scenario fails
+#
+# python bench/delivery.py [scenario]
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+from telegram.error import NetworkError, TimedOut
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import e2e
+import main
+
+CHAT_ID = 1
+
+
+# Tweets of one account, all built from one recorded tweet, the first is text only and the third has a video
+def timeline(count, template=0):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tweets.json')) as f:
+        template = json.load(f)[template]
+    return e2e.FakeTwitter(['account'], count, 0, 100000, templates=[template])
+
+
+# Wrap send_post to count the posts of each tweet, failing calls raise an error after or before posting
+def counting(send_post, posts, failures):
+    def send(context, chat_id, post):
+        failure = failures.pop(post.id, None)
+        if failure is not None and not failure[1]:
+            raise failure[0]
+        send_post(context, chat_id, post)
+        for id in post.tweet_ids:
+            posts[id] = posts.get(id, 0) + 1
+        if failure is not None:
+            raise failure[0]
+    return send
+
+
+# Run fetch cycles every interval seconds until the chat's cursor reaches the newest tweet or the timeout, returns
+# the number of posts of each tweet
+def run_cycles(twitter, failures, interval, timeout):
+    main.twitter = lambda: twitter
+    main.session = e2e.FakeSession(0, 1000)
+    main.save_video_youtube_dl = e2e.fake_save_video(0, 1000)
+    bot = e2e.FakeBot(0)
+    posts = {}
+    main.send_post = counting(main.send_post, posts, failures)
+    main.subscribers[CHAT_ID] = {'accounts': {'account': e2e.FIRST_ID - 1}, 'replies': True}
+    main.send_queue.start()
+    main.pipeline.start()
+    context = types.SimpleNamespace(bot=bot, bot_data={}, dispatcher=types.SimpleNamespace(persistence=None))
+    newest = twitter.timelines['account'][-1].id
+    start = time.monotonic()
+    while main.subscribers[CHAT_ID]['accounts']['account'] < newest and time.monotonic() - start < timeout:
+        main.scheduler.defer('account', 0)
+        main.fetch_tweets(context)
+        time.sleep(interval)
+    return posts
+
+
+# Return what went wrong: tweets not posted exactly once, or a cursor short of the newest tweet
+def check(twitter, posts):
+    problems = []
+    for status in twitter.timelines['account']:
+        if posts.get(status.id, 0) != 1:
+            problems.append('tweet ' + str(status.id - e2e.FIRST_ID) + ' posted ' + str(posts.get(status.id, 0)) +
+                            ' times')
+    cursor = main.subscribers[CHAT_ID]['accounts']['account']
+    if cursor < twitter.timelines['account'][-1].id:
+        problems.append('cursor stopped at tweet ' + str(cursor - e2e.FIRST_ID))
+    return problems
+
+
+# A send fails while the chat's backlog takes longer than a cycle to send: the failed tweet is posted on a later
+# cycle, the tweets still queued behind it aren't handed out again
+def transient_failure_backlog():
+    main.SEND_RETRIES = 0
+    main.CHAT_SENDS_PER_SECOND = 10
+    twitter = timeline(30)
+    failures = {twitter.timelines['account'][2].id: (NetworkError('Bad Gateway'), False)}
+    return check(twitter, run_cycles(twitter, failures, 1.5, 30))
+
+
+# A reply to a deleted tweet: it's posted on its own and the cursor moves past it, rather than being held for
+# a replied tweet no later cycle gets
+def deleted_parent():
+    twitter = timeline(5)
+    reply = twitter.timelines['account'][2]
+    reply.in_reply_to_status_id = 1
+    reply.in_reply_to_screen_name = 'someone'
+    return check(twitter, run_cycles(twitter, {}, 0.5, 10))
+
+
+# A video upload times out after Telegram posted it: it isn't sent again, by the send queue or a later cycle
+def timed_out_upload():
+    twitter = timeline(5, 2)
+    failures = {twitter.timelines['account'][2].id: (TimedOut(), True)}
+    return check(twitter, run_cycles(twitter, failures, 0.5, 10))
+
+
+SCENARIOS = {
+    'transient-failure-backlog': transient_failure_backlog,
+    'deleted-parent': deleted_parent,
+    'timed-out-upload': timed_out_upload,
+}
+
+
+def main_bench():
+    names = sys.argv[1:] or list(SCENARIOS)
+    failed = False
+    for name in names:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name],
+                                capture_output=True, text=True)
+        problems = result.stdout.strip()
+        if result.returncode != 0:
+            problems = problems or result.stderr.strip().splitlines()[-1]
+        failed = failed or result.returncode != 0
+        print('{:<28} {}'.format(name, 'FAIL ' + problems if result.returncode != 0 else 'ok'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        problems = SCENARIOS[sys.argv[2]]()
+        print(', '.join(problems))
+        sys.exit(1 if len(problems) > 0 else 0)
+    else:
+        main_bench()
@@ -0,0 +1,232 @@
+# End-to-end benchmark of fetching and posting tweets, with local stand-ins for the Twitter API,
+# the media hosts and the Telegram bot so it runs offline without credentials
+#
+# python bench/e2e.py --users 40 --accounts 30 --follows 10 --tweets 20
+import argparse
+import copy
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import types
+import tweepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+
+FIRST_ID = 1400000000000000000
+
+
+# Twitter API serving generated timelines built from the recorded tweets, or from the given templates
+class FakeTwitter:
+    def __init__(self, accounts, tweets_per_account, latency, rate_limit, templates=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.last_response = None
+        self.timelines = {}
+        self.statuses = {}
+
+        if templates is None:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tweets.json')) as f:
+                templates = json.load(f)
+        id = FIRST_ID
+        for i in range(tweets_per_account):
+            for account in accounts:
+                data = copy.deepcopy(templates[i % len(templates)])
+                timeline = self.timelines.setdefault(account, [])
+                data['id'] = id
+                data['id_str'] = str(id)
+                data['user']['screen_name'] = account
+                if data['in_reply_to_status_id'] is not None:
+                    # Reply to the previous tweet of the account, or to one outside the timelines
+                    data['in_reply_to_status_id'] = timeline[-1].id if timeline else id - 1
+                    data['in_reply_to_screen_name'] = account
+                status = tweepy.models.Status.parse(None, data)
+                timeline.append(status)
+                self.statuses[id] = status
+                id += 1
+        self.parent = tweepy.models.Status.parse(None, dict(templates[0], id=FIRST_ID - 1))
+        self.statuses[FIRST_ID - 1] = self.parent
+
+    def call(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            remaining = self.rate_limit - self.calls[endpoint]
+        headers = {'x-rate-limit-limit': str(self.rate_limit), 'x-rate-limit-remaining': str(max(remaining, 0)),
+                   'x-rate-limit-reset': str(int(time.time()) + 60*main.RATE_LIMIT_WINDOW_MINUTES)}
+        self.last_response = types.SimpleNamespace(headers=headers)
+        time.sleep(self.latency)
+        if remaining < 0:
+            raise tweepy.RateLimitError('Rate limit exceeded')
+
+    def user_timeline(self, screen_name, count=20, since_id=None, max_id=None, exclude_replies=False, **kwargs):
+        self.call('statuses/user_timeline')
+        statuses = [status for status in reversed(self.timelines.get(screen_name, []))
+                    if (since_id is None or status.id > since_id) and (max_id is None or status.id <= max_id)]
+        statuses = statuses[:count]
+        if exclude_replies:
+            statuses = [status for status in statuses if status.in_reply_to_status_id is None]
+        return statuses
+
+    def get_status(self, id, **kwargs):
+        self.call('statuses/show')
+        if id not in self.statuses:
+            raise tweepy.TweepError('No status found with that ID.', types.SimpleNamespace(status_code=404), 144)
+        return self.statuses[id]
+
+    def statuses_lookup(self, ids, **kwargs):
+        self.call('statuses/lookup')
+        return [self.statuses[id] for id in ids if id in self.statuses]
+
+
+# Telegram bot answering every call after a fixed latency
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.file_ids = 0
+        self.calls = 0
+
+    def send(self, chat_id, text):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            self.file_ids += 1
+            file_id = 'file' + str(self.file_ids)
+        media = types.SimpleNamespace(file_id=file_id)
+        return types.SimpleNamespace(message_id=self.file_ids, photo=[media], video=media, animation=None,
+                                     document=None)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.send(chat_id, text)
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        return self.send(chat_id, caption)
+
+    def send_video(self, chat_id, video, caption=None, **kwargs):
+        return self.send(chat_id, caption)
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        return [self.send(chat_id, media[0].caption)] + [self.send(chat_id, None) for item in media[1:]]
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        time.sleep(self.latency)
+
+
+# HTTP session for media downloads
+class FakeSession:
+    def __init__(self, latency, size):
+        self.latency = latency
+        self.size = size
+
+    def get(self, url, stream=False, **kwargs):
+        time.sleep(self.latency)
+        raw = io.BytesIO(b'\0' * self.size)
+        response = types.SimpleNamespace(status_code=200, raw=raw, headers={'Content-Length': str(self.size)},
+                                         iter_content=lambda chunk_size: iter(lambda: raw.read(chunk_size), b''))
+        response.__enter__ = lambda: response
+        return FakeResponse(response)
+
+
+class FakeResponse:
+    def __init__(self, response):
+        self.response = response
+
+    def __enter__(self):
+        return self.response
+
+    def __exit__(self, *args):
+        pass
+
+
+# youtube_dl fallback writing a file of the given size
+def fake_save_video(latency, size):
+    def save_video(video_url, filename):
+        time.sleep(latency)
+        f = main.MediaBuffer(filename + '.mp4')
+        f.write(b'\0' * size)
+        return f
+    return save_video
+
+
+# Wrap send_post to record when each tweet reaches each chat
+def recording(send_post, sent):
+    def record(context, chat_id, post):
+        send_post(context, chat_id, post)
+        for id in post.tweet_ids:
+            sent[(chat_id, id)] = time.perf_counter()
+    return record
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(args):
+    accounts = ['account' + str(i) for i in range(args.accounts)]
+    twitter = FakeTwitter(accounts, args.tweets, args.twitter_latency / 1000, args.rate_limit)
+    bot = FakeBot(args.telegram_latency / 1000)
+
+    main.twitter = lambda: twitter
+    main.session = FakeSession(args.download_latency / 1000, args.media_size)
+    main.save_video_youtube_dl = fake_save_video(args.download_latency / 1000, args.media_size)
+    sent = {}
+    main.send_post = recording(main.send_post, sent)
+    main.CHAT_SENDS_PER_SECOND = main.GLOBAL_SENDS_PER_SECOND = args.send_rate
+    main.CHAT_SEND_BURST = main.GLOBAL_SEND_BURST = args.send_rate
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    # Every user follows a window of the accounts, all starting before the first tweet
+    expected = set()
+    for user_id in range(1, args.users + 1):
+        followed = [accounts[(user_id + i) % len(accounts)] for i in range(min(args.follows, len(accounts)))]
+        user_data = {'accounts': {account: FIRST_ID - 1 for account in followed}, 'replies': True}
+        main.subscribers[user_id] = user_data
+        for account in followed:
+            expected.update((user_id, status.id) for status in twitter.timelines[account])
+
+    main.send_queue.start()
+    main.pipeline.start()
+    context = types.SimpleNamespace(bot=bot, bot_data={}, dispatcher=types.SimpleNamespace(persistence=None))
+    start = time.perf_counter()
+    main.fetch_tweets(context)
+    while len(expected - sent.keys()) > 0 and time.perf_counter() - start < args.timeout:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    delivered = expected & sent.keys()
+    latencies = sorted(sent[key] - start for key in delivered)
+    api_calls = sum(twitter.calls.values())
+    unique_tweets = len({id for user_id, id in delivered})
+    print('users ' + str(args.users) + ', accounts ' + str(args.accounts) + ', follows ' + str(args.follows) +
+          ', tweets per account ' + str(args.tweets))
+    print('delivered        ' + str(len(delivered)) + '/' + str(len(expected)) + ' in ' + str(round(elapsed, 2)) + ' s')
+    print('tweets/sec       ' + str(round(len(delivered) / elapsed, 1)))
+    print('API calls        ' + str(api_calls) + ' ' + str(twitter.calls))
+    print('API calls/tweet  ' + str(round(api_calls / max(unique_tweets, 1), 3)))
+    print('Telegram calls   ' + str(bot.calls))
+    if len(latencies) > 0:
+        print('latency p50      ' + str(round(percentile(latencies, 0.5) * 1000)) + ' ms')
+        print('latency p99      ' + str(round(percentile(latencies, 0.99) * 1000)) + ' ms')
+    print('peak RSS         ' + str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)) + ' MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of fetch_tweets')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--accounts', type=int, default=30)
+    parser.add_argument('--follows', type=int, default=10, help='accounts followed per user')
+    parser.add_argument('--tweets', type=int, default=20, help='new tweets per account')
+    parser.add_argument('--twitter-latency', type=float, default=50, help='ms per Twitter API call')
+    parser.add_argument('--telegram-latency', type=float, default=20, help='ms per Telegram API call')
+    parser.add_argument('--download-latency', type=float, default=30, help='ms per media download')
+    parser.add_argument('--media-size', type=int, default=100000, help='bytes per downloaded media file')
+    parser.add_argument('--rate-limit', type=int, default=1500, help='Twitter calls per endpoint per window')
+    parser.add_argument('--send-rate', type=float, default=1000, help='Telegram sends per second')
+    parser.add_argument('--timeout', type=float, default=300)
+    run(parser.parse_args())
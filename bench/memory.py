@@ -0,0 +1,75 @@
+# Memory benchmark of catching up on a large backlog: peak RSS of holding the fetched tweets as tweepy
+# Status objects, as fetch cycles used to, against the compact Tweet records built at fetch time.
+# Each variant runs in its own process so the peaks don't mix
+#
+# python bench/memory.py [tweets]
+import copy
+import json
+import os
+import resource
+import subprocess
+import sys
+import tweepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+
+FIRST_ID = 1400000000000000000
+PAGE_SIZE = 200
+
+
+# Timeline pages of count tweets as JSON, as the Twitter API returns them
+def pages(count):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tweets.json')) as f:
+        templates = json.load(f)
+    for start in range(0, count, PAGE_SIZE):
+        page = []
+        for i in range(start, min(start + PAGE_SIZE, count)):
+            data = copy.deepcopy(templates[i % len(templates)])
+            data['id'] = FIRST_ID + i
+            data['id_str'] = str(FIRST_ID + i)
+            page.append(data)
+        yield json.dumps(page)
+
+
+# Fetch count tweets a page at a time and keep them all, like a cycle catching up
+def catch_up(count, compact):
+    tweets = []
+    for page in pages(count):
+        statuses = [tweepy.models.Status.parse(None, data) for data in json.loads(page)]
+        if compact:
+            statuses = [main.Tweet(status) for status in statuses]
+        tweets.extend(statuses)
+    return tweets
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs in the child process, prints the peak RSS before and after catching up in MB
+def child(variant, count):
+    before = peak_rss()
+    tweets = catch_up(count, variant == 'records')
+    print(str(before) + ' ' + str(peak_rss()) + ' ' + str(len(tweets)))
+
+
+def main_bench():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(str(count) + ' tweets')
+    results = []
+    for variant in ['statuses', 'records']:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', variant, str(count)],
+                                check=True, capture_output=True, text=True).stdout.split()
+        before, after = float(output[0]), float(output[1])
+        results.append((variant, before, after))
+    for variant, before, after in results:
+        print('{:<9} peak RSS {:7.1f} MB, {:6.1f} MB for the tweets, {:5.2f} KB/tweet'.format(
+            variant, after, after - before, (after - before) * 1024 / count))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main_bench()
@@ -0,0 +1,205 @@
+# Micro-benchmark of rendering tweets into messages: the single-pass entity renderer against the
+# previous regex and str.replace path, on the recorded tweets in tweets.json
+#
+# python bench/render.py [iterations]
+import html
+import json
+import os
+import re
+import sys
+import time
+import tweepy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+
+
+# Load the recorded tweets, returns the tweets and a dict of id to tweet for replies
+def load_corpus():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tweets.json')) as f:
+        statuses = [tweepy.models.Status.parse(None, data) for data in json.load(f)]
+    return statuses, {status.id: status for status in statuses}
+
+
+# The corpus as the records the bot renders, which are built when tweets are fetched
+def load_records(statuses):
+    tweets = [main.Tweet(status) for status in statuses]
+    return tweets, {tweet.id: tweet for tweet in tweets}
+
+
+# Previous rendering path of post_tweet, kept as the baseline
+def legacy_render(status, replied_status):
+    is_reply = status.in_reply_to_status_id is not None
+    if is_reply:
+        is_self_reply = status.in_reply_to_screen_name == status.user.screen_name
+    else:
+        is_self_reply = False
+    is_retweet = hasattr(status, 'retweeted_status')
+
+    header = legacy_link_to_tweet(status, is_reply, is_self_reply)
+
+    if is_retweet:
+        is_self_rt = status.user.screen_name == status.retweeted_status.user.screen_name
+        status = status.retweeted_status
+
+    message = status.full_text
+
+    if is_reply:
+        replied_message = replied_status.full_text
+        message = legacy_remove_initial_mentions(message)
+
+    if hasattr(status, 'quoted_status'):
+        quoted_message = status.quoted_status.full_text
+
+    if is_reply and hasattr(replied_status, 'quoted_status'):
+        replied_quoted_message = replied_status.quoted_status.full_text
+
+    # Expand URLs
+    message = legacy_expand_urls(status, message)
+    if is_reply:
+        replied_message = legacy_expand_urls(replied_status, replied_message)
+    if hasattr(status, 'quoted_status'):
+        quoted_message = legacy_expand_urls(status, quoted_message)
+    if is_reply and hasattr(replied_status, 'quoted_status'):
+        replied_quoted_message = legacy_expand_urls(replied_status.quoted_status, replied_quoted_message)
+
+    # Remove t.co links
+    message = re.sub(r'https://t.co/\w{10}', '', message)
+    if is_reply:
+        replied_message = re.sub(r'https://t.co/\w{10}', '', replied_message)
+        if hasattr(replied_status, 'quoted_status'):
+            replied_quoted_message = re.sub(r'https://t.co/\w{10}', '', replied_quoted_message)
+    if hasattr(status, 'quoted_status'):
+        quoted_message = re.sub(r'https://t.co/\w{10}', '', quoted_message)
+
+    # If it's a quote tweet, remove the link to the quoted tweet
+    if hasattr(status, 'quoted_status'):
+        quote_url = status.quoted_status_permalink['expanded']
+        message = message.replace(quote_url, '')
+    if is_reply and hasattr(replied_status, 'quoted_status'):
+        quote_url = replied_status.quoted_status_permalink['expanded']
+        replied_message = replied_message.replace(quote_url, '')
+
+    if is_retweet:
+        if is_self_rt:
+            message = header + '\n' + message
+        else:
+            retweeted_header = legacy_link_to_tweet(status)
+            message = header + '\n' + 'RT ' + retweeted_header + '\n' + message
+    if hasattr(status, 'quoted_status'):
+        quoted_header = legacy_link_to_tweet(status.quoted_status)
+        message = message.strip()
+        if len(message) != 0:
+            message = message + '\n\n'
+        message = '\n' + message + 'RT ' + quoted_header + '\n' + quoted_message
+        if not is_retweet:
+            message = header + message
+    if not is_retweet and not hasattr(status, 'quoted_status'):
+        message = header + '\n' + message
+
+    if is_reply:
+        replied_message = replied_message.strip()
+        if len(replied_message) != 0:
+            replied_message = replied_message + '\n\n'
+        if hasattr(replied_status, 'quoted_status'):
+            replied_quoted_message = replied_quoted_message.strip()
+            if len(replied_quoted_message) != 0:
+                replied_quoted_message = replied_quoted_message + '\n\n'
+            else:
+                replied_quoted_message = replied_quoted_message + '\n'
+            replied_quoted_header = legacy_link_to_tweet(replied_status.quoted_status)
+            message = legacy_link_to_tweet(replied_status) + '\n' + replied_message + 'RT ' + \
+                replied_quoted_header + '\n' + replied_quoted_message + message
+        else:
+            message = legacy_link_to_tweet(replied_status) + '\n' + replied_message + message
+
+    image_urls = []
+    video_url = ''
+    if legacy_has_media(status):
+        image_urls = legacy_images(status)
+        video_url = legacy_video(status)
+    if hasattr(status, 'quoted_status'):
+        if legacy_has_media(status.quoted_status) and not legacy_has_media(status):
+            image_urls = legacy_images(status.quoted_status)
+            video_url = legacy_video(status.quoted_status)
+    if is_reply and len(image_urls) == 0 and len(video_url) == 0:
+        if legacy_has_media(replied_status):
+            image_urls = legacy_images(replied_status)
+            video_url = legacy_video(replied_status)
+        elif hasattr(replied_status, 'quoted_status') and legacy_has_media(replied_status.quoted_status):
+            image_urls = legacy_images(replied_status.quoted_status)
+            video_url = legacy_video(replied_status.quoted_status)
+    return message, image_urls, video_url
+
+
+def legacy_expand_urls(status, message):
+    if hasattr(status, 'retweeted_status'):
+        status = status.retweeted_status
+    for embedded_url in status.entities.get('urls', [{}]):
+        message = message.replace(embedded_url['url'], embedded_url['expanded_url'])
+    return message
+
+
+def legacy_remove_initial_mentions(text):
+    return re.sub(r'^(@([A-Za-z0-9-_]+[A-Za-z0-9-_]+)\s)+', '', text).lstrip()
+
+
+def legacy_link_to_tweet(status, is_reply=False, is_self_reply=False):
+    url = 'https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id)
+    link = '<a href="' + url + '">' + html.escape(status.user.name, quote=False) + ' (@' + \
+           status.user.screen_name + ')' + '</a>'
+    if is_reply or is_self_reply:
+        if is_self_reply:
+            link += ' continued:'
+        else:
+            link += ' replied:'
+    return link
+
+
+def legacy_has_media(status):
+    return hasattr(status, 'extended_entities') and 'media' in status.extended_entities
+
+
+def legacy_images(status):
+    image_urls = []
+    for media in status.extended_entities.get('media', [{}]):
+        if media.get('type', None) == 'photo':
+            image_urls.append(media['media_url'])
+    return image_urls
+
+
+def legacy_video(status):
+    for media in status.extended_entities.get('media', [{}]):
+        if media.get('type', None) == 'video' or media.get('type', None) == 'animated_gif':
+            return 'https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id)
+    return ''
+
+
+# Return the time per tweet in microseconds of rendering the corpus iterations times
+def measure(render, statuses, parents, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        for status in statuses:
+            render(status, parents.get(status.in_reply_to_status_id))
+    return (time.perf_counter() - start) / (iterations * len(statuses)) * 1000000
+
+
+def main_bench():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    statuses, parents = load_corpus()
+    tweets, tweet_parents = load_records(statuses)
+
+    results = [
+        ('legacy', measure(legacy_render, statuses, parents, iterations)),
+        ('single pass', measure(main.render_tweet, tweets, tweet_parents, iterations)),
+        # Every subscriber after the first gets the rendered tweet from the cache
+        ('memoized', measure(lambda status, replied_status: main.render_post(status, tweet_parents),
+                             tweets, tweet_parents, iterations)),
+    ]
+    print(str(len(statuses)) + ' tweets x ' + str(iterations) + ' iterations')
+    for name, microseconds in results:
+        print('{:<12} {:8.2f} us/tweet  {:5.2f}x'.format(name, microseconds, results[0][1] / microseconds))
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,168 @@
+# Benchmark of answering pasted tweet links over the webhook against long polling, with a local stand-in for
+# the Telegram Bot API behind the real telegram Bot and Updater, and the Twitter and media fakes of e2e.py.
+# Every message links several tweets, which are fetched with one statuses/lookup
+#
+# python bench/webhook.py --mode webhook --messages 50 --links 5
+import argparse
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+import requests
+from telegram import Bot
+from telegram.ext import Updater
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import e2e
+import main
+
+USERNAME = 'bench'
+
+
+# Telegram Bot API answering the bot's requests after a fixed latency, and handing it the users' messages
+# through getUpdates
+class FakeTelegram:
+    def __init__(self, latency):
+        # Connections the Updater expects the bot's Request to have
+        self.con_pool_size = 8
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.updates = queue.Queue()
+        self.calls = {}
+        self.sent = {}
+        self.message_ids = 0
+        self.webhook_url = None
+
+    def post(self, url, data, timeout=None):
+        method = url.split('/')[-1]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self.get_updates(data.get('timeout', 0))
+        time.sleep(self.latency)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'setWebhook':
+            self.webhook_url = data['url']
+            return True
+        if method == 'sendMediaGroup':
+            return [self.message(data['chat_id'], 'photo') for item in data['media']]
+        if method in ['sendMessage', 'sendPhoto', 'sendVideo']:
+            return self.message(data['chat_id'], method[4:].lower())
+        return True
+
+    def message(self, chat_id, kind):
+        with self.lock:
+            self.message_ids += 1
+            message_id = self.message_ids
+            self.sent.setdefault(int(chat_id), []).append(time.perf_counter())
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': int(chat_id), 'type': 'private'}}
+        file = {'file_id': 'file' + str(message_id), 'file_unique_id': 'unique' + str(message_id), 'width': 1,
+                'height': 1}
+        if kind == 'photo':
+            message['photo'] = [file]
+        elif kind == 'video':
+            message['video'] = dict(file, duration=1)
+        return message
+
+    # Long poll: wait for the next message of a user, which arrives after the latency
+    def get_updates(self, timeout):
+        try:
+            update = self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        time.sleep(self.latency)
+        return [update]
+
+    # A user sends a message: Telegram posts it to the webhook, or holds it for getUpdates
+    def receive(self, update):
+        if self.webhook_url is None:
+            self.updates.put(update)
+            return
+        time.sleep(self.latency)
+        requests.post(self.webhook_url, json=update).raise_for_status()
+
+
+# Update of a user pasting links, with the URL entities Telegram marks them with
+def link_message(update_id, user_id, urls):
+    text = ''
+    entities = []
+    for url in urls:
+        entities.append({'type': 'url', 'offset': len(text), 'length': len(url)})
+        text += url + '\n'
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text, 'entities': entities,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': USERNAME, 'username': USERNAME}}}
+
+
+def run(args):
+    accounts = ['account' + str(i) for i in range(10)]
+    tweets_per_account = (args.messages * args.links) // len(accounts) + 1
+    twitter = e2e.FakeTwitter(accounts, tweets_per_account, args.twitter_latency / 1000, 100000)
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+
+    main.twitter = lambda: twitter
+    main.session = e2e.FakeSession(args.download_latency / 1000, args.media_size)
+    main.save_video_youtube_dl = e2e.fake_save_video(args.download_latency / 1000, args.media_size)
+    main.AUTHORIZED_USERS = [USERNAME]
+    main.CHAT_SENDS_PER_SECOND = main.GLOBAL_SENDS_PER_SECOND = 1000
+    main.CHAT_SEND_BURST = main.GLOBAL_SEND_BURST = 1000
+    if args.mode == 'webhook':
+        main.WEBHOOK_URL = 'http://127.0.0.1:' + str(args.port)
+        main.WEBHOOK_LISTEN = '127.0.0.1'
+        main.WEBHOOK_PORT = args.port
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    updater = Updater(bot=Bot('123:bench', request=telegram), use_context=True)
+    main.add_handlers(updater.dispatcher)
+    main.send_queue.start()
+    main.start_updates(updater)
+
+    # Each message comes from its own user and is answered with one post per link
+    statuses = sorted(twitter.statuses.values(), key=lambda status: status.id)[1:]
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.messages):
+        links = statuses[i * args.links:(i + 1) * args.links]
+        urls = ['https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id) for status in links]
+        user_id = i + 1
+        sent = time.perf_counter()
+        telegram.receive(link_message(i + 1, user_id, urls))
+        deadline = sent + args.timeout
+        while len(telegram.sent.get(user_id, [])) < len(links) and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        if len(telegram.sent.get(user_id, [])) > 0:
+            latencies.append((telegram.sent[user_id][0] - sent, max(telegram.sent[user_id]) - sent))
+    elapsed = time.perf_counter() - start
+    updater.stop()
+
+    answered = len(latencies)
+    first = sorted(latency[0] for latency in latencies)
+    last = sorted(latency[1] for latency in latencies)
+    print('mode ' + args.mode + ', messages ' + str(args.messages) + ', links per message ' + str(args.links))
+    print('answered         ' + str(answered) + '/' + str(args.messages) + ' in ' + str(round(elapsed, 2)) + ' s')
+    print('API calls        ' + str(sum(twitter.calls.values())) + ' ' + str(twitter.calls))
+    print('API calls/msg    ' + str(round(sum(twitter.calls.values()) / max(args.messages, 1), 2)))
+    print('Telegram calls   ' + str(telegram.calls))
+    if answered > 0:
+        print('first post p50   ' + str(round(e2e.percentile(first, 0.5) * 1000)) + ' ms')
+        print('last post p50    ' + str(round(e2e.percentile(last, 0.5) * 1000)) + ' ms')
+        print('last post p99    ' + str(round(e2e.percentile(last, 0.99) * 1000)) + ' ms')
+    print('peak RSS         ' + str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)) + ' MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of answering tweet links over the webhook')
+    parser.add_argument('--mode', choices=['webhook', 'polling'], default='webhook')
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--links', type=int, default=5, help='tweet links per message')
+    parser.add_argument('--port', type=int, default=8443, help='port of the local webhook')
+    parser.add_argument('--twitter-latency', type=float, default=50, help='ms per Twitter API call')
+    parser.add_argument('--telegram-latency', type=float, default=20, help='ms per Telegram API call')
+    parser.add_argument('--download-latency', type=float, default=30, help='ms per media download')
+    parser.add_argument('--media-size', type=int, default=100000, help='bytes per downloaded media file')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the posts of a message')
+    run(parser.parse_args())
@@ -1,15 +1,32 @@
 import logging
+import bisect
+import functools
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
+import queue
 import random
-import re
+import secrets
 import shutil
-import string
+import sqlite3
+import tempfile
+import threading
+import time
 import tweepy
 import requests
 import youtube_dl
-from telegram import Update, InputMediaPhoto
-from telegram.error import TimedOut, NetworkError, BadRequest
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, PicklePersistence
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from telegram import Bot, Update, InputMediaPhoto, MessageEntity
+from telegram.error import NetworkError, BadRequest, RetryAfter, TimedOut
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, BasePersistence
 
 # Enable logging
 logging.basicConfig(
@@ -21,17 +38,305 @@ logger = logging.getLogger(__name__)
 # Twitter API authentication
 CONSUMER_KEY = ''
 CONSUMER_SECRET = ''
-auth = tweepy.AppAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
+# Created on first use
+auth = None
 
-# Create Twitter API object
-api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+# Twitter API objects, one per thread so each reads the rate limit headers of its own calls
+apis = threading.local()
 
 # Telegram users which may interact with the bot
 AUTHORIZED_USERS = ['']
 # Telegram bot token
 BOT_TOKEN = ''
-# Fetch new posts at this interval
+# Poll accounts at this interval until their posting rate is known
 DELAY_MINUTES = 5
+# Bounds of the polling interval of an account, which is adapted to its posting rate
+MIN_DELAY_MINUTES = 1
+MAX_DELAY_MINUTES = 60
+# Accounts are polled when this many new tweets are expected
+TWEETS_PER_POLL = 1
+# Weight of the latest poll in an account's posting rate (EWMA)
+RATE_SMOOTHING = 0.3
+# Twitter rate limits per 15 minute window, updated from the x-rate-limit-* headers
+RATE_LIMITS = {'statuses/user_timeline': 1500, 'statuses/show': 900, 'statuses/lookup': 300}
+RATE_LIMIT_WINDOW_MINUTES = 15
+# Maximum number of tweets per statuses/lookup request
+LOOKUP_BATCH_SIZE = 100
+# Number of fetched tweets kept in memory and how long they are reused
+STATUS_CACHE_SIZE = 2000
+STATUS_CACHE_TTL_MINUTES = 60
+# Number of Telegram file_ids of sent media kept for reuse and how long they stay valid
+MEDIA_INDEX_SIZE = 5000
+MEDIA_INDEX_TTL_DAYS = 30
+# Number of images downloaded in parallel
+DOWNLOAD_WORKERS = 4
+# Downloads are kept in memory up to this size, larger ones spill to an anonymous file in ./media/
+SPOOL_MAX_MEMORY = 5*1024*1024
+
+# Largest video bots may upload to Telegram, and the size of the chunks videos are streamed in
+VIDEO_MAX_BYTES = 50*1024*1024
+VIDEO_CHUNK_SIZE = 1024*1024
+
+# Number of worker threads of each pipeline stage: timelines fetched, batches rendered,
+# posts whose media is downloaded and posts sent in parallel
+FETCH_WORKERS = 4
+RENDER_WORKERS = 1
+MEDIA_WORKERS = 2
+SEND_WORKERS = 2
+# Number of items waiting between two pipeline stages before the earlier stage blocks
+PIPELINE_QUEUE_SIZE = 20
+
+# Most new tweets of an account posted in one cycle, when catching up after downtime the older ones
+# are skipped with a note
+CATCH_UP_MAX_TWEETS = 200
+
+# Post a thread of self-replies fetched in one cycle as one post, split at Telegram's length limits for
+# messages and for captions of media
+COALESCE_THREADS = True
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+# Telegram flood limits: messages per second overall and per chat, and how many may be sent in a burst
+GLOBAL_SENDS_PER_SECOND = 25
+GLOBAL_SEND_BURST = 25
+CHAT_SENDS_PER_SECOND = 1
+CHAT_SEND_BURST = 3
+# Number of times a send failing with a network error is retried, the delay doubles each time. Timeouts aren't
+# retried since the message may have been posted
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 2
+# SQLite database with the bot state, and the pickle file of older versions it is migrated from
+DATABASE = 'db.sqlite3'
+PICKLE_DATABASE = 'db'
+
+# Number of worker processes polling and posting, users and followed accounts are spread over them by consistent
+# hashing and this process only handles commands. Each account is polled by one worker, which shares the tweets
+# through the database with the workers of its followers. 0 runs everything in this process
+WORKERS = 0
+# Workers write a heartbeat to the database this often, and are taken off the hash ring when it's older
+# than WORKER_TIMEOUT_SECONDS
+WORKER_HEARTBEAT_SECONDS = 10
+WORKER_TIMEOUT_SECONDS = 60
+# Points per worker on the hash ring, more spread users more evenly
+WORKER_RING_POINTS = 100
+
+# Receive updates on a webhook instead of polling getUpdates: Telegram posts them to WEBHOOK_URL/<secret path>,
+# which must reach WEBHOOK_LISTEN:WEBHOOK_PORT. None polls
+WEBHOOK_URL = None
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+# Secret path of the webhook so only Telegram can post updates, a random one is generated at startup if empty
+WEBHOOK_SECRET = ''
+# Certificate and private key files to serve the webhook over TLS, the certificate is uploaded to Telegram so it
+# may be self-signed. None serves plain HTTP, for a reverse proxy that terminates TLS
+WEBHOOK_CERT = None
+WEBHOOK_KEY = None
+
+# Port to serve Prometheus metrics on at http://METRICS_HOST:METRICS_PORT/metrics, None turns metrics off
+METRICS_PORT = None
+METRICS_HOST = '127.0.0.1'
+
+# Users fetching tweets: chat id -> their user_data, restored from the database at boot
+subscribers = {}
+# With WORKERS, account -> (oldest cursor of its active followers on all workers, whether any of them wants
+# replies) for the accounts that hash to this worker, which polls them for everyone
+owned_accounts = None
+
+
+# Thread safe LRU cache whose entries expire after ttl seconds
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Return the cached value or None
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                # Expired
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return 'size ' + str(len(self)) + '/' + str(self.maxsize) + ', hits ' + str(self.hits) + \
+               ', misses ' + str(self.misses) + ', evictions ' + str(self.evictions)
+
+
+# Fetched tweets by id
+status_cache = LRUCache(STATUS_CACHE_SIZE, 60*STATUS_CACHE_TTL_MINUTES)
+# Rendered tweets by id, shared by all subscribers
+render_cache = LRUCache(STATUS_CACHE_SIZE, 60*STATUS_CACHE_TTL_MINUTES)
+
+# Keep-alive HTTP session and thread pool for media downloads
+session = requests.Session()
+# Images download on the pool, videos on the media workers of the pipeline
+session.mount('https://', HTTPAdapter(pool_connections=DOWNLOAD_WORKERS,
+                                      pool_maxsize=DOWNLOAD_WORKERS + MEDIA_WORKERS))
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+
+
+# Downloaded media, in memory until it grows past SPOOL_MAX_MEMORY, named for Telegram to tell the file type
+class MediaBuffer(tempfile.SpooledTemporaryFile):
+    def __init__(self, name):
+        super().__init__(max_size=SPOOL_MAX_MEMORY, dir='./media')
+        self.filename = name
+
+    @property
+    def name(self):
+        return self.filename
+
+
+# Counters and histograms in memory, rendered in the Prometheus text format
+class Metrics:
+    # Upper bounds in seconds of the latency histogram buckets
+    BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Name -> [type, help, buckets], in the order they are rendered
+        self.families = OrderedDict()
+        # Name -> {labels: value} for counters, {labels: [bucket counts, sum, count]} for histograms,
+        # labels are a tuple of (label, value) pairs
+        self.values = {}
+        # Name -> function returning the current value
+        self.gauges = {}
+
+        self.histogram('twittertg_call_seconds', 'Duration of Twitter, download and Telegram calls')
+        self.counter('twittertg_errors_total', 'Calls that raised, by exception type')
+        self.counter('twittertg_downloaded_bytes_total', 'Bytes of media downloaded')
+        self.counter('twittertg_uploaded_bytes_total', 'Bytes of media uploaded to Telegram')
+        self.histogram('twittertg_fetch_cycle_seconds', 'Duration of fetching and merging the due accounts')
+        # Relative to the default polling interval
+        self.histogram('twittertg_job_lag_seconds', 'Delay of account polls past their scheduled time',
+                       [60*DELAY_MINUTES * fraction for fraction in [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5]])
+        self.gauge('twittertg_send_queue_depth', 'Sends waiting in the send queue', lambda: send_queue.size)
+        self.gauge('twittertg_status_cache_size', 'Tweets in the tweet cache', lambda: len(status_cache))
+
+    def counter(self, name, help):
+        self.families[name] = ['counter', help, None]
+        self.values[name] = {}
+
+    def histogram(self, name, help, buckets=None):
+        self.families[name] = ['histogram', help, buckets or Metrics.BUCKETS]
+        self.values[name] = {}
+
+    def gauge(self, name, help, value):
+        self.families[name] = ['gauge', help, None]
+        self.gauges[name] = value
+
+    def inc(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        buckets = self.families[name][2]
+        with self.lock:
+            values = self.values[name]
+            if labels not in values:
+                values[labels] = [[0] * len(buckets), 0, 0]
+            histogram = values[labels]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help, buckets) in self.families.items():
+                lines.append('# HELP ' + name + ' ' + help)
+                lines.append('# TYPE ' + name + ' ' + kind)
+                if kind == 'gauge':
+                    lines.append(name + ' ' + str(self.gauges[name]()))
+                elif kind == 'counter':
+                    for labels, value in sorted(self.values[name].items()):
+                        lines.append(name + format_labels(labels) + ' ' + str(value))
+                else:
+                    for labels, (counts, total, count) in sorted(self.values[name].items()):
+                        for bound, bucket_count in zip(buckets, counts):
+                            lines.append(name + '_bucket' + format_labels(labels + (('le', str(bound)),)) + ' ' +
+                                         str(bucket_count))
+                        lines.append(name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+                        lines.append(name + '_sum' + format_labels(labels) + ' ' + str(total))
+                        lines.append(name + '_count' + format_labels(labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+
+# Returns labels as {label="value",...}
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(label + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for label, value in labels) + '}'
+
+
+# Serves the metrics on /metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# None when metrics are off, the hooks then cost nothing
+metrics = Metrics() if METRICS_PORT is not None else None
+
+
+# Records the duration and errors of each call of a function, which is left as is when metrics are off
+def timed(function):
+    if metrics is None:
+        return function
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            metrics.inc('twittertg_errors_total', function=name, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('twittertg_call_seconds', time.perf_counter() - start, function=name)
+    return wrapper
+
 
 def authorized(update: Update):
     return update.message.from_user['username'] in AUTHORIZED_USERS
@@ -49,35 +354,35 @@ def cmd_start(update: Update, context: CallbackContext) -> None:
     else:
         update.message.reply_text('Resuming...')
 
-    user_id = update.message.from_user['id']
-    current_jobs = context.job_queue.get_jobs_by_name(str(user_id))
-    if not current_jobs:
-        context.job_queue.run_repeating(fetch_tweets, interval=60*DELAY_MINUTES, first=1,
-                                        context=[update, context], name=str(user_id))
+    # Active users are restored at boot, with WORKERS the worker the user hashes to picks them up on its
+    # next cycle
+    context.user_data['active'] = True
+    if WORKERS == 0:
+        subscribers[update.message.from_user['id']] = context.user_data
 
 
-# Stop the repeating job
+# Stop fetching tweets for the user
 def cmd_stop(update: Update, context: CallbackContext) -> None:
     if not authorized(update): return
     user_id = update.message.from_user['id']
-    current_jobs = context.job_queue.get_jobs_by_name(str(user_id))
-    if current_jobs:
-        for job in current_jobs:
-            job.schedule_removal()
-            update.message.reply_text('Stopped fetching tweets')
+    active = context.user_data.pop('active', False)
+    if subscribers.pop(user_id, None) is not None or active:
+        update.message.reply_text('Stopped fetching tweets')
 
 
 # Send a message when the command /help is issued
 def cmd_help(update: Update, context: CallbackContext) -> None:
     if not authorized(update): return
-    update.message.reply_text('/start - resume fetching tweets, necessary after bot restart\n' +
+    update.message.reply_text('/start - start fetching tweets, resumed after bot restart\n' +
                               '/stop - pause fetching tweets\n' +
                               '/help - list of commands\n' +
                               '/follow account_handle - follow Twitter account\n' +
                               '/unfollow account_handle - unfollow Twitter account\n' +
                               '/list - list all followed Twitter accounts\n' +
                               '/replies [on/off] - include replies, default is on\n' +
-                              '/caption - reply to a media post with this to remove the caption\n\n\n'
+                              '/caption - reply to a media post with this to remove the caption\n' +
+                              '/stats - cache, rate limit and send queue statistics\n' +
+                              '/schedule - when each followed account is polled next\n\n\n'
                               'Send a tweet link to turn it into a Telegram post.\n')
 
 
@@ -162,190 +467,697 @@ def cmd_caption(update: Update, context: CallbackContext) -> None:
             return
 
 
-# Fetch and post a tweet
+# Show cache statistics
+def cmd_stats(update: Update, context: CallbackContext) -> None:
+    if not authorized(update): return
+    if WORKERS > 0:
+        update.message.reply_text('Accounts are polled by ' + str(WORKERS) + ' worker processes, these stats ' +
+                                  'only cover linked tweets:\n\n' +
+                                  'Tweet cache: ' + status_cache.stats() + '\n' +
+                                  'Render cache: ' + render_cache.stats() + '\n\n' +
+                                  'Send queue: ' + send_queue.stats())
+        return
+    update.message.reply_text('Tweet cache: ' + status_cache.stats() + '\n' +
+                              'Render cache: ' + render_cache.stats() + '\n\n' + rate_limits.stats() + '\n\n' +
+                              'Send queue: ' + send_queue.stats())
+
+
+# Show the polling schedule
+def cmd_schedule(update: Update, context: CallbackContext) -> None:
+    if not authorized(update): return
+    if WORKERS > 0:
+        update.message.reply_text('Accounts are polled by ' + str(WORKERS) + ' worker processes, which keep ' +
+                                  'their own schedules.')
+        return
+    lines = []
+    for account, next_poll, interval, rate in scheduler.schedule():
+        lines.append('@' + account + ' in ' + str(max(0, round(next_poll / 60))) + ' min, every ' +
+                     str(round(interval / 60)) + ' min, ' + str(round(rate * 60 * 60 * 24, 1)) + ' tweets/day')
+    if len(lines) == 0:
+        update.message.reply_text('No accounts are polled.')
+    else:
+        update.message.reply_text('\n'.join(lines))
+
+
+# Fetch and post the tweets linked in a message, all of them and their replied tweets are fetched together
 def cmd_get_tweet(update: Update, context: CallbackContext) -> None:
     if not authorized(update): return
-    url = update.message.text
+    ids = tweet_ids_in_message(update.message)
+    if len(ids) == 0:
+        logger.error('Invalid URL: ' + update.message.text)
+        return
     try:
+        statuses = get_tweets(ids)
+        parents = hydrate(statuses.values())
+    except Exception as e:
+        logger.error('Failed to fetch tweets: ' + update.message.text + '\n' + str(e))
+        return
+    for id in ids:
+        if id not in statuses:
+            logger.error('Tweet not found: ' + str(id))
+            continue
+        try:
+            post_tweet(context, update.message.from_user['id'], statuses[id], parents)
+        except Exception as e:
+            logger.error('Failed to post tweet: ' + str(id) + '\n' + str(e))
+
+
+# Ids of the tweets linked in a message in order, a message that is only a tweet id is that tweet
+def tweet_ids_in_message(message):
+    urls = [entity.url or text for entity, text in
+            message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK]).items()]
+    urls = [url for url in urls if '/status/' in url] or [message.text.strip()]
+    ids = []
+    for url in urls:
         try:
             id = id_from_url(url)
         except ValueError:
-            logger.error('Invalid URL: ' + update.message.text)
-            return
-        status = get_tweet(id)
-        post_tweet(update, context, status)
-    except Exception as e:
-        logger.error('Failed to post tweet: ' + update.message.text + '\n' + str(e))
+            continue
+        if id not in ids:
+            ids.append(id)
+    return ids
+
+
+# A tweet rendered into a Telegram post
+class Post:
+    def __init__(self, status, message='', image_urls=None, video_url='', video_info=None):
+        self.id = status.id
+        self.url = 'https://twitter.com/' + status.screen_name + '/status/' + str(status.id)
+        self.message = message
+        self.image_urls = image_urls or []
+        self.video_url = video_url
+        # Duration and MP4 variants of the video, to download it without youtube_dl
+        self.video_info = video_info
+        # Text messages sent after the post for the rest of a thread, and the ids of all its tweets
+        self.continuations = []
+        self.tweet_ids = [status.id]
+        # Downloaded media: media URL -> filename or in-memory buffer
+        self.media = {}
+        # Exception that stopped the post from being rendered or downloaded
+        self.error = None
+        # Pipeline state: chat id -> position in the chat's order, chat id -> (account, since_id) the
+        # chat's cursor moves to once the post is sent, chats not yet sent to
+        self.chats = {}
+        self.checkpoints = {}
+        self.pending = 0
+        self.context = None
+
+
+# Processes tweet and posts it to the bot, parents maps ids to already fetched replied tweets
+def post_tweet(context: CallbackContext, chat_id, status, parents=None):
+    post = render_post(status, parents)
+    tmp_msg = None
+    if len(post.video_url) > 0 and cached_file_id(context, post.video_url) is None:
+        tmp_msg = context.bot.send_message(chat_id=chat_id, text='Downloading video ...')
+    try:
+        download_media(context, post)
+        for future in queue_post(context, chat_id, post):
+            future.result()
+    finally:
+        release_media(post)
+        if tmp_msg is not None:
+            context.bot.delete_message(chat_id=chat_id, message_id=tmp_msg.message_id)
+
+
+# Renders a tweet into a post, rendered tweets are reused across subscribers and cycles
+def render_post(status, parents=None):
+    rendered = render_cache.get(status.id)
+    if rendered is None:
+        replied_status = get_parent(status, parents)
+        rendered = render_tweet(status, replied_status)
+        if replied_status is not None or status.in_reply_to_status_id is None:
+            render_cache.put(status.id, rendered)
+    return Post(status, *rendered)
+
+
+# Renders a thread of self-replies into one post: the first tweet as usual, followed by the text of the
+# others, split into more messages where it's over Telegram's length limits
+def render_thread(statuses, parents=None):
+    post = render_post(statuses[0], parents)
+    if len(statuses) == 1:
+        return post
+    parts = [post.message]
+    for status in statuses[1:]:
+        text = render_text(status, skip_mentions=True).strip()
+        if len(text) > 0:
+            parts.append(text)
+    has_media = len(post.image_urls) > 0 or len(post.video_url) > 0
+    messages = split_message(parts, CAPTION_LIMIT if has_media else MESSAGE_LIMIT)
+    post.message = messages[0]
+    post.continuations = messages[1:]
+    post.tweet_ids = [status.id for status in statuses]
+    return post
+
+
+# Check if a tweet continues a thread after the previous tweet, only replies with nothing but text are
+# merged into the thread's post
+def continues(previous, status):
+    return status.in_reply_to_status_id == previous.id and status.in_reply_to_screen_name == status.screen_name \
+        and previous.screen_name == status.screen_name and not has_media(status) and \
+        status.quoted_status is None and status.retweeted_status is None
+
+
+# Join the parts of a message with blank lines into as few messages as the length limits allow, the
+# first message has its own limit, parts are never split
+def split_message(parts, first_limit):
+    messages = []
+    message = parts[0]
+    for part in parts[1:]:
+        limit = first_limit if len(messages) == 0 else MESSAGE_LIMIT
+        if message_length(message + '\n\n' + part) > limit:
+            messages.append(message)
+            message = part
+        else:
+            message += '\n\n' + part
+    messages.append(message)
+    return messages
+
+
+# Length of a message in the UTF-16 code units Telegram counts, markup included to stay on the safe side
+def message_length(message):
+    return len(message.encode('utf-16-le')) // 2
 
 
-# Processes tweet and posts it to the bot
-def post_tweet(update: Update, context: CallbackContext, status):
+# Return the tweet a reply replies to from parents or by fetching it, None if it's not a reply
+# or the rate limit doesn't allow fetching it
+def get_parent(status, parents=None):
+    if status.in_reply_to_status_id is None:
+        return None
+    if parents is not None and status.in_reply_to_status_id in parents:
+        return parents[status.in_reply_to_status_id]
+    try:
+        return get_tweet(status.in_reply_to_status_id)
+    except tweepy.RateLimitError:
+        # Post the reply without the replied tweet rather than holding it back
+        logger.warning('Rate limited, posting without replied tweet: ' + str(status.id))
+        return None
+    except tweepy.TweepError as e:
+        # The replied tweet was deleted or is protected, no later attempt gets it either
+        if e.api_code not in [144, 179]:
+            raise
+        logger.warning('Replied tweet unavailable, posting without it: ' + str(status.id))
+        return None
+
+
+# Turns a tweet into the HTML message text, image URLs and video URL of a post, without API calls
+def render_tweet(status, replied_status=None):
     is_reply = status.in_reply_to_status_id is not None
     if is_reply:
-        is_self_reply = status.in_reply_to_screen_name == status.user.screen_name
+        is_self_reply = status.in_reply_to_screen_name == status.screen_name
     else:
         is_self_reply = False
-    is_retweet = hasattr(status, 'retweeted_status')
+    is_retweet = status.retweeted_status is not None
 
     header = link_to_tweet(status, is_reply, is_self_reply)
 
     if is_retweet:
-        is_self_rt = status.user.screen_name == status.retweeted_status.user.screen_name
+        is_self_rt = status.screen_name == status.retweeted_status.screen_name
         status = status.retweeted_status
 
-    message = status.full_text
-
-    if is_reply:
-        replied_status = get_tweet(status.in_reply_to_status_id)
-        replied_message = replied_status.full_text
-        message = remove_initial_mentions(message)
-
-    if hasattr(status, 'quoted_status'):
-        quoted_message = status.quoted_status.full_text
-
-    if is_reply and hasattr(replied_status, 'quoted_status'):
-        replied_quoted_message = replied_status.quoted_status.full_text
+    # Leading mentions of a reply clutter up threads
+    message = render_text(status, skip_mentions=is_reply)
+    is_reply = replied_status is not None
+    is_quote = status.quoted_status is not None
 
-    # Expand URLs
-    message = expand_urls(status, message)
+    parts = []
     if is_reply:
-        replied_message = expand_urls(replied_status, replied_message)
-    if hasattr(status, 'quoted_status'):
-        quoted_message = expand_urls(status, quoted_message)
-    if is_reply and hasattr(replied_status, 'quoted_status'):
-        replied_quoted_message = expand_urls(replied_status.quoted_status, replied_quoted_message)
-
-    # Remove t.co links
-    message = re.sub(r'https://t.co/\w{10}', '', message)
-    if is_reply:
-        replied_message = re.sub(r'https://t.co/\w{10}', '', replied_message)
-        if hasattr(replied_status, 'quoted_status'):
-            replied_quoted_message = re.sub(r'https://t.co/\w{10}', '', replied_quoted_message)
-    if hasattr(status, 'quoted_status'):
-        quoted_message = re.sub(r'https://t.co/\w{10}', '', quoted_message)
-
-    # If it's a quote tweet, remove the link to the quoted tweet
-    if hasattr(status, 'quoted_status'):
-        quote_url = status.quoted_status_permalink['expanded']
-        message = message.replace(quote_url, '')
-    if is_reply and hasattr(replied_status, 'quoted_status'):
-        quote_url = replied_status.quoted_status_permalink['expanded']
-        replied_message = replied_message.replace(quote_url, '')
-
-    if is_retweet:
-        if is_self_rt:
-            message = header + '\n' + message
-        else:
-            retweeted_header = link_to_tweet(status)
-            message = header + '\n' + 'RT ' + retweeted_header + '\n' + message
-    if hasattr(status, 'quoted_status'):
-        quoted_header = link_to_tweet(status.quoted_status)
+        parts.append(link_to_tweet(replied_status) + '\n')
+        replied_message = render_text(replied_status).strip()
+        if len(replied_message) != 0:
+            parts.append(replied_message + '\n\n')
+        if replied_status.quoted_status is not None:
+            replied_quoted_message = render_text(replied_status.quoted_status).strip()
+            parts.append('RT ' + link_to_tweet(replied_status.quoted_status) + '\n' + replied_quoted_message +
+                         ('\n\n' if len(replied_quoted_message) != 0 else '\n'))
+
+    parts.append(header + '\n')
+    if is_retweet and not is_self_rt:
+        parts.append('RT ' + link_to_tweet(status) + '\n')
+    if is_quote:
         message = message.strip()
         if len(message) != 0:
-            message = message + '\n\n'
-        message = '\n' + message + 'RT ' + quoted_header + '\n' + quoted_message
-        if not is_retweet:
-            message = header + message
-    if not is_retweet and not hasattr(status, 'quoted_status'):
-        message = header + '\n' + message
-
-    if is_reply:
-        replied_message = replied_message.strip()
-        if len(replied_message) != 0:
-            replied_message = replied_message + '\n\n'
-        if hasattr(replied_status, 'quoted_status'):
-            replied_quoted_message = replied_quoted_message.strip()
-            if len(replied_quoted_message) != 0:
-                replied_quoted_message = replied_quoted_message + '\n\n'
-            else:
-                replied_quoted_message = replied_quoted_message + '\n'
-            replied_quoted_header = link_to_tweet(replied_status.quoted_status)
-            message = link_to_tweet(replied_status) + '\n' + replied_message + 'RT ' + replied_quoted_header + '\n' + replied_quoted_message + message
-        else:
-            message = link_to_tweet(replied_status) + '\n' + replied_message + message
+            parts.append(message + '\n\n')
+        parts.append('RT ' + link_to_tweet(status.quoted_status) + '\n' + render_text(status.quoted_status))
+    else:
+        parts.append(message)
+    message = ''.join(parts)
 
     # Check if there is media embedded
     image_urls = []
     video_url = ''
+    video_info = None
     if has_media(status):
         image_urls = images(status)
-        video_url = video(status)
+        video_url, video_info = video(status), status.video_info
 
-    if hasattr(status, 'quoted_status'):
+    if is_quote:
         if has_media(status.quoted_status) and not has_media(status):
             image_urls = images(status.quoted_status)
-            video_url = video(status.quoted_status)
+            video_url, video_info = video(status.quoted_status), status.quoted_status.video_info
 
     if is_reply and len(image_urls) == 0 and len(video_url) == 0:
         if has_media(replied_status):
             image_urls = images(replied_status)
-            video_url = video(replied_status)
-        elif hasattr(replied_status, 'quoted_status') and has_media(replied_status.quoted_status):
+            video_url, video_info = video(replied_status), replied_status.video_info
+        elif replied_status.quoted_status is not None and has_media(replied_status.quoted_status):
             image_urls = images(replied_status.quoted_status)
-            video_url = video(replied_status.quoted_status)
-
-    if len(image_urls) > 0:
+            video_url, video_info = video(replied_status.quoted_status), replied_status.quoted_status.video_info
+
+    return message, image_urls, video_url, video_info
+
+
+# Renders the text of a tweet to HTML in a single pass over its links
+def render_text(status, skip_mentions=False):
+    # Twitter already escapes &, < and > in the text
+    text = status.full_text
+    position = status.text_start if skip_mentions else 0
+
+    parts = []
+    for begin, url, replacement in status.links:
+        if text[begin:begin + len(url)] != url:
+            # Indices don't line up with the text, e.g. after escaped characters
+            begin = text.find(url, position)
+        if begin < position:
+            continue
+        parts.append(text[position:begin])
+        parts.append(replacement)
+        position = begin + len(url)
+    parts.append(text[position:])
+    return ''.join(parts).lstrip() if skip_mentions else ''.join(parts)
+
+
+# Sends a post with downloaded media to a chat, call through the send queue
+def send_post(context, chat_id, post):
+    if len(post.image_urls) > 0:
         # Tweet contains one or more images
-        filenames = save_images(image_urls)
         try:
-            if len(image_urls) == 1:
-                send_image_post(update, context, message, filenames[0])
-            else:
-                # More than one image
-                try:
-                    send_gallery_post(update, context, message, filenames)
-                except BadRequest as e:
-                    failed_url = 'https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id)
-                    logger.error('BadRequest: ' + failed_url)
-        except TimedOut:
-            logger.error('TimedOut: https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id))
-        for filename in filenames:
-            os.remove(filename)
-
-    if len(video_url) > 0:
+            send_images(context, chat_id, post)
+        except BadRequest:
+            if not forget_file_ids(context, post.image_urls):
+                raise
+            # A reused file_id is no longer valid, upload the images again
+            download_media(context, post)
+            send_images(context, chat_id, post)
+
+    if len(post.video_url) > 0:
         # Tweet contains a video
-        tmp_msg = context.bot.send_message(chat_id=update.message.from_user['id'], text='Downloading video ...')
-        filename = save_video(video_url, str(status.id))
-        if os.path.exists(filename + '.mp4'):
-            try:
-                post_msg = None
-                try:
-                    post_msg = send_video_post(update, context, message, filename + '.mp4')
-                except NetworkError:
-                    # try again
-                    logger.error('NetworkError, trying again: ' + filename)
-                    if post_msg is not None:
-                        send_video_post(update, context, message, filename + '.mp4')
-            except TimedOut:
-                logger.error('TimedOut: https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id))
-            os.remove(filename + '.mp4')
-            context.bot.delete_message(chat_id=update.message.from_user['id'], message_id=tmp_msg.message_id)
-        else:
-            logger.error('File extension error: ' + filename)
+        try:
+            send_video(context, chat_id, post)
+        except BadRequest:
+            if not forget_file_ids(context, [post.video_url]):
+                raise
+            download_media(context, post)
+            send_video(context, chat_id, post)
 
-    if len(image_urls) == 0 and len(video_url) == 0:
+    if len(post.image_urls) == 0 and len(post.video_url) == 0:
         # Only text in the post
-        try:
-            send_text_post(update, context, message)
-        except TimedOut:
-            logger.error('TimedOut: https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id))
+        send_text_post(context, chat_id, post.message)
+
+
+# Queue a post and each continuation of its thread as sends of their own, so retrying a send doesn't repeat the
+# messages already sent, returns the futures of the sends in order
+def queue_post(context, chat_id, post):
+    futures = [send_queue.put(chat_id, lambda: send_post(context, chat_id, post), post_cost(post), post.url)]
+    for message in post.continuations:
+        futures.append(send_queue.put(chat_id, functools.partial(send_continuation, context, chat_id, message,
+                                                                 list(futures)), 1, post.url))
+    return futures
+
+
+# Send the next part of a thread unless an earlier one failed, a chat's sends run one at a time in order
+def send_continuation(context, chat_id, message, previous):
+    if all(future.exception() is None for future in previous):
+        send_text_post(context, chat_id, message)
+
+
+# Return the error of the first send of a post that failed, or None
+def send_error(futures):
+    for future in futures:
+        if future.exception() is not None:
+            return future.exception()
+    return None
+
+
+# Number of messages a post counts as against the flood limits, not counting the continuations
+def post_cost(post):
+    return max(len(post.image_urls), 1) + (1 if len(post.image_urls) > 0 and len(post.video_url) > 0 else 0)
+
+
+# Downloads the media of a post which Telegram doesn't already have a file_id for
+def download_media(context, post):
+    missing = [image_url for image_url in post.image_urls
+               if image_url not in post.media and cached_file_id(context, image_url) is None]
+    for image_url, download in zip(missing, save_images(missing)):
+        post.media[image_url] = download
+
+    if len(post.video_url) > 0 and post.video_url not in post.media and \
+            cached_file_id(context, post.video_url) is None:
+        download = save_video(post.video_url, post.video_info, str(post.id))
+        if download is not None:
+            post.media[post.video_url] = download
+            if metrics is not None:
+                metrics.inc('twittertg_downloaded_bytes_total', download.seek(0, os.SEEK_END))
+
+
+# Closes the downloaded media of a post, which frees their memory or files
+def release_media(post):
+    for download in post.media.values():
+        download.close()
+    post.media = {}
+
+
+# Return what to send for media: its Telegram file_id, or the downloaded buffer rewound
+def media_input(context, post, key):
+    file_id = cached_file_id(context, key)
+    if file_id is not None:
+        return file_id
+    download = post.media[key]
+    if metrics is not None:
+        metrics.inc('twittertg_uploaded_bytes_total', download.seek(0, os.SEEK_END))
+    download.seek(0)
+    return download
+
+
+# Sends the images of a post, images which were sent before are reused by their Telegram file_id
+def send_images(context, chat_id, post):
+    photos = [media_input(context, post, image_url) for image_url in post.image_urls]
+    if len(photos) == 1:
+        post_msgs = [send_image_post(context, chat_id, post.message, photos[0])]
+    else:
+        # More than one image
+        post_msgs = send_gallery_post(context, chat_id, post.message, photos)
+    for image_url, post_msg in zip(post.image_urls, post_msgs):
+        cache_file_id(context, image_url, post_msg.photo[-1].file_id)
 
 
-# Removes mentions that clutter up threads
-def remove_initial_mentions(text):
-    regex_mentions = '^(@([A-Za-z0-9-_]+[A-Za-z0-9-_]+)\s)+'
-    replaced = re.sub(regex_mentions, '', text)
-    return replaced.lstrip()
+# Sends the video of a post, a video which was sent before is reused by its Telegram file_id
+def send_video(context, chat_id, post):
+    if post.video_url not in post.media and cached_file_id(context, post.video_url) is None:
+        # Download failed
+        return
+    video = media_input(context, post, post.video_url)
+    post_msg = send_video_post(context, chat_id, post.message, video)
+    # GIFs come back as animations
+    media = post_msg.video or post_msg.animation or post_msg.document
+    cache_file_id(context, post.video_url, media.file_id)
+
+
+# Return the Telegram file_id of media that was sent before, or None
+def cached_file_id(context, key):
+    entry = context.bot_data.get('media', {}).get(key)
+    if entry is None or entry[1] < time.time() - 60*60*24*MEDIA_INDEX_TTL_DAYS:
+        return None
+    entry[1] = time.time()
+    return entry[0]
+
+
+# Remember the Telegram file_id of sent media, evicting stale and least recently used entries
+def cache_file_id(context, key, file_id):
+    media = context.bot_data.setdefault('media', {})
+    media[key] = [file_id, time.time()]
+    if len(media) > MEDIA_INDEX_SIZE:
+        oldest_allowed = time.time() - 60*60*24*MEDIA_INDEX_TTL_DAYS
+        entries = sorted(list(media.items()), key=lambda item: item[1][1])
+        for i, (key, entry) in enumerate(entries):
+            if entry[1] < oldest_allowed or i < len(entries) - MEDIA_INDEX_SIZE:
+                media.pop(key, None)
+
+
+# Forget the Telegram file_ids of media, returns True if any were known
+def forget_file_ids(context, keys):
+    media = context.bot_data.get('media', {})
+    return any([media.pop(key, None) is not None for key in keys])
+
+
+# Stores user and bot data as rows in SQLite, only rows that changed are written
+class SQLitePersistence(BasePersistence):
+    def __init__(self, filename, pickle_filename=None, shared=False):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=True)
+        self.filename = filename
+        # Other processes write to the database too, with WORKERS
+        self.shared = shared
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS accounts (
+                user_id INTEGER NOT NULL, account TEXT NOT NULL, since_id INTEGER,
+                PRIMARY KEY (user_id, account));
+            CREATE TABLE IF NOT EXISTS settings (
+                user_id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (user_id, key));
+            CREATE TABLE IF NOT EXISTS bot_data (
+                name TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,
+                PRIMARY KEY (name, key));
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS timelines (
+                account TEXT PRIMARY KEY, since_id INTEGER NOT NULL, truncated INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS tweets (
+                account TEXT NOT NULL, id INTEGER NOT NULL, status BLOB NOT NULL,
+                PRIMARY KEY (account, id));
+        ''')
+        self.lock = threading.Lock()
+        # What the database holds: user id -> (accounts, settings) and bot data name -> {key: value}
+        self.users = {}
+        self.bot_rows = {}
+        if pickle_filename is not None and os.path.exists(pickle_filename):
+            self.migrate(pickle_filename)
+
+    # One-shot import of the state of a PicklePersistence file, which is renamed afterwards
+    def migrate(self, pickle_filename):
+        with open(pickle_filename, 'rb') as f:
+            data = pickle.load(f)
+        self.load()
+        for user_id, user_data in data.get('user_data', {}).items():
+            self.update_user_data(user_id, user_data)
+        self.update_bot_data(data.get('bot_data', {}))
+        os.rename(pickle_filename, pickle_filename + '.migrated')
+        logger.warning('Migrated ' + pickle_filename + ' to ' + self.filename)
+
+    # Read the rows the database holds
+    def load(self):
+        self.load_users()
+        self.load_bot_rows()
+
+    def load_users(self):
+        with self.lock:
+            self.users = {}
+            for user_id, account, since_id in self.connection.execute(
+                    'SELECT user_id, account, since_id FROM accounts'):
+                self.users.setdefault(user_id, ({}, {}))[0][account] = since_id
+            for user_id, key, value in self.connection.execute('SELECT user_id, key, value FROM settings'):
+                self.users.setdefault(user_id, ({}, {}))[1][key] = value
+
+    # Bot data rows are only read at startup and by refresh_bot_data, which merges them, so rows other processes
+    # wrote aren't taken for rows this one deleted
+    def load_bot_rows(self):
+        with self.lock:
+            self.bot_rows = self.read_bot_rows()
+
+    def read_bot_rows(self):
+        bot_rows = {}
+        for name, key, value in self.connection.execute('SELECT name, key, value FROM bot_data'):
+            bot_rows.setdefault(name, {})[key] = value
+        return bot_rows
+
+    def get_user_data(self):
+        self.load_users()
+        user_data = defaultdict(dict)
+        for user_id, (accounts, settings) in self.users.items():
+            user_data[user_id]['accounts'] = dict(accounts)
+            for key, value in settings.items():
+                user_data[user_id][key] = json.loads(value)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    # Every value of bot_data is a dict, each item is stored in its own row
+    def get_bot_data(self):
+        self.load_bot_rows()
+        bot_data = {}
+        for name, rows in self.bot_rows.items():
+            bot_data[name] = {key: pickle.loads(value) for key, value in rows.items()}
+        return bot_data
+
+    # Merge the rows other processes wrote or deleted since the last read into bot_data, which keeps the media
+    # index shared by workers and the bot. Called by the dispatcher before each update and by workers each cycle
+    def refresh_bot_data(self, bot_data):
+        if not self.shared:
+            return
+        with self.lock:
+            previous = self.bot_rows
+            self.bot_rows = self.read_bot_rows()
+            for name, rows in self.bot_rows.items():
+                values = bot_data.setdefault(name, {})
+                for key, value in rows.items():
+                    if previous.get(name, {}).get(key) != value:
+                        values[key] = pickle.loads(value)
+            for name, rows in previous.items():
+                values = bot_data.get(name, {})
+                for key, value in rows.items():
+                    # Deleted elsewhere, and not changed here since
+                    if key not in self.bot_rows.get(name, {}) and key in values and \
+                            pickle.dumps(values[key]) == value:
+                        del values[key]
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_user_data(self, user_id, data):
+        accounts = dict(data.get('accounts', {}))
+        settings = {key: json.dumps(value) for key, value in data.items() if key != 'accounts'}
+        with self.lock:
+            stored_accounts, stored_settings = self.users.get(user_id, ({}, {}))
+            statements = []
+            for account in stored_accounts.keys() - accounts.keys():
+                statements.append(('DELETE FROM accounts WHERE user_id = ? AND account = ?', (user_id, account)))
+            for account, since_id in accounts.items():
+                if stored_accounts.get(account, -1) != since_id:
+                    statements.append(('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)',
+                                       (user_id, account, since_id)))
+            for key in stored_settings.keys() - settings.keys():
+                statements.append(('DELETE FROM settings WHERE user_id = ? AND key = ?', (user_id, key)))
+            for key, value in settings.items():
+                if stored_settings.get(key) != value:
+                    statements.append(('INSERT OR REPLACE INTO settings VALUES (?, ?, ?)', (user_id, key, value)))
+            self.execute(statements)
+            self.users[user_id] = (accounts, settings)
+
+    def update_bot_data(self, data):
+        with self.lock:
+            statements = []
+            for name in self.bot_rows.keys() - data.keys():
+                statements.append(('DELETE FROM bot_data WHERE name = ?', (name,)))
+                del self.bot_rows[name]
+            for name, values in data.items():
+                stored = self.bot_rows.setdefault(name, {})
+                rows = {key: pickle.dumps(value) for key, value in list(values.items())}
+                for key in stored.keys() - rows.keys():
+                    statements.append(('DELETE FROM bot_data WHERE name = ? AND key = ?', (name, key)))
+                for key, value in rows.items():
+                    if stored.get(key) != value:
+                        statements.append(('INSERT OR REPLACE INTO bot_data VALUES (?, ?, ?)', (name, key, value)))
+                self.bot_rows[name] = rows
+            self.execute(statements)
+
+    # Move a user's cursor of an account forward, an account unfollowed in the meantime stays unfollowed
+    def update_since_id(self, user_id, account, since_id):
+        with self.lock:
+            self.execute([('UPDATE accounts SET since_id = ? WHERE user_id = ? AND account = ? AND since_id < ?',
+                           (since_id, user_id, account, since_id))])
+            stored_accounts = self.users.get(user_id, ({}, {}))[0]
+            if account in stored_accounts and stored_accounts[account] < since_id:
+                stored_accounts[account] = since_id
+
+    def heartbeat(self, worker_id):
+        with self.lock:
+            self.execute([('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, time.time()))])
+
+    # Return the workers with a heartbeat in the last timeout seconds
+    def live_workers(self, timeout):
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT worker_id FROM workers WHERE heartbeat > ?',
+                                                              (time.time() - timeout,))]
+
+    # Replace the shared timeline of an account with the tweets fetched after since_id, newest first. With
+    # WORKERS the worker polling an account shares them this way with the workers of its other followers
+    def store_timeline(self, account, since_id, tweets, truncated):
+        # Nobody needs the older tweets, and a truncated fetch leaves a gap before the tweets it kept
+        oldest = tweets[-1].id - 1 if truncated else since_id
+        statements = [('DELETE FROM tweets WHERE account = ? AND id <= ?', (account, oldest)),
+                      ('INSERT OR REPLACE INTO timelines VALUES (?, ?, ?)', (account, since_id, int(truncated)))]
+        for tweet in tweets:
+            statements.append(('INSERT OR REPLACE INTO tweets VALUES (?, ?, ?)',
+                               (account, tweet.id, pickle.dumps(tweet))))
+        with self.lock:
+            self.execute(statements)
+
+    # Return the tweets of an account's shared timeline after since_id newest first, whether tweets before them
+    # were left out, and the id the timeline was fetched from, followers behind it wait for the next poll
+    def read_timeline(self, account, since_id):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                timeline = self.connection.execute('SELECT since_id, truncated FROM timelines WHERE account = ?',
+                                                   (account,)).fetchone()
+                rows = self.connection.execute('SELECT id, status FROM tweets WHERE account = ? AND id > ? '
+                                               'ORDER BY id DESC', (account, since_id)).fetchall()
+                oldest = self.connection.execute('SELECT MIN(id) FROM tweets WHERE account = ?',
+                                                 (account,)).fetchone()[0]
+            finally:
+                self.connection.execute('COMMIT')
+        if timeline is None:
+            # Not polled yet
+            return [], False, 0
+        truncated = bool(timeline[1]) and len(rows) > 0 and rows[-1][0] == oldest
+        return [pickle.loads(status) for id, status in rows], truncated, timeline[0]
+
+    # Delete the shared timelines of accounts nobody follows anymore
+    def drop_timelines(self, accounts):
+        statements = []
+        for account in accounts:
+            statements.append(('DELETE FROM tweets WHERE account = ?', (account,)))
+            statements.append(('DELETE FROM timelines WHERE account = ?', (account,)))
+        with self.lock:
+            self.execute(statements)
+
+    # Run statements in a single transaction
+    def execute(self, statements):
+        if len(statements) == 0:
+            return
+        self.connection.execute('BEGIN')
+        try:
+            for statement, parameters in statements:
+                self.connection.execute(statement, parameters)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def flush(self):
+        with self.lock:
+            self.connection.close()
 
 
 # Main function
 def main():
-    pp = PicklePersistence(filename='db')
-    updater = Updater(BOT_TOKEN, use_context=True, persistence=pp)
+    sweep_media()
+    persistence = SQLitePersistence(DATABASE, PICKLE_DATABASE, WORKERS > 0)
+    updater = Updater(BOT_TOKEN, use_context=True, persistence=persistence)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
+    add_handlers(dispatcher)
+
+    # Posts tweets linked in messages, and with WORKERS=0 the tweets of followed accounts
+    send_queue.start()
+    if WORKERS > 0:
+        processes = [start_worker(index) for index in range(WORKERS)]
+        threading.Thread(target=supervise_workers, args=(processes,), name='supervisor', daemon=True).start()
+    else:
+        restore_subscribers(dispatcher.user_data)
+        pipeline.start()
+        # A single job polls the accounts of all users
+        updater.job_queue.run_repeating(fetch_tweets, interval=60*MIN_DELAY_MINUTES, first=1, name='fetch_tweets')
+
+    if metrics is not None:
+        serve_metrics(METRICS_PORT)
+
+    # Start the bot
+    start_updates(updater)
+    # Ctrl-C to exit
+    updater.idle()
+
 
+def add_handlers(dispatcher):
     dispatcher.add_handler(CommandHandler('start', cmd_start))
     dispatcher.add_handler(CommandHandler('stop', cmd_stop))
     dispatcher.add_handler(CommandHandler('help', cmd_help))
@@ -354,46 +1166,672 @@ def main():
     dispatcher.add_handler(CommandHandler('list', cmd_list))
     dispatcher.add_handler(CommandHandler('replies', cmd_replies))
     dispatcher.add_handler(CommandHandler('caption', cmd_caption))
+    dispatcher.add_handler(CommandHandler('stats', cmd_stats))
+    dispatcher.add_handler(CommandHandler('schedule', cmd_schedule))
 
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, cmd_get_tweet))
 
-    # Start the bot
-    updater.start_polling()
-    # Ctrl-C to exit
-    updater.idle()
-
 
-# Fetch all new tweets for all followed accounts
+# Receive updates on the webhook when WEBHOOK_URL is set, Telegram then pushes each update as it arrives,
+# otherwise poll for them
+def start_updates(updater):
+    if WEBHOOK_URL is None:
+        updater.start_polling()
+        return
+    url_path = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    updater.start_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=url_path, cert=WEBHOOK_CERT,
+                          key=WEBHOOK_KEY, webhook_url=WEBHOOK_URL.rstrip('/') + '/' + url_path)
+
+
+# Resume fetching tweets for the users that were active when the bot stopped, their first polls are spread
+# over the polling interval
+def restore_subscribers(user_data):
+    accounts = []
+    for user_id, data in user_data.items():
+        if data.get('active', False):
+            subscribers[user_id] = data
+            accounts.extend(data.get('accounts', {}))
+    scheduler.stagger(accounts, 60*DELAY_MINUTES)
+    logger.info('Restored ' + str(len(subscribers)) + ' users following ' + str(len(set(accounts))) + ' accounts')
+
+
+# Serve the metrics on a port of METRICS_HOST from a background thread
+def serve_metrics(port):
+    server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+
+def start_worker(index):
+    process = multiprocessing.get_context('spawn').Process(target=run_worker, args=(index, WORKERS),
+                                                           name='worker-' + str(index), daemon=True)
+    process.start()
+    return process
+
+
+# Restart workers that exit, their users are served by the other workers until they're back
+def supervise_workers(processes):
+    while True:
+        time.sleep(WORKER_HEARTBEAT_SECONDS)
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                logger.error('Worker ' + str(index) + ' exited with ' + str(process.exitcode) + ', restarting')
+                processes[index] = start_worker(index)
+
+
+# Worker process: posts for the active users that hash to it on the ring of live workers, and polls the
+# accounts that hash to it
+def run_worker(index, workers):
+    global rate_limits, GLOBAL_SENDS_PER_SECOND, GLOBAL_SEND_BURST
+    worker_id = 'worker-' + str(index)
+    # The Twitter app's rate limits and the bot's flood limit are shared by all workers, the per chat
+    # flood limit isn't since each chat is served by one worker
+    rate_limits = RateLimits(RATE_LIMITS, 1 / workers)
+    GLOBAL_SENDS_PER_SECOND = GLOBAL_SENDS_PER_SECOND / workers
+    GLOBAL_SEND_BURST = max(GLOBAL_SEND_BURST // workers, 1)
+
+    persistence = SQLitePersistence(DATABASE, shared=True)
+    context = WorkerContext(Bot(BOT_TOKEN), persistence)
+    if metrics is not None:
+        serve_metrics(METRICS_PORT + 1 + index)
+    send_queue.start()
+    pipeline.start()
+
+    next_cycle = 0
+    while True:
+        persistence.heartbeat(worker_id)
+        if time.monotonic() >= next_cycle:
+            next_cycle = time.monotonic() + 60*MIN_DELAY_MINUTES
+            ring = HashRing(persistence.live_workers(WORKER_TIMEOUT_SECONDS))
+            assign_users(persistence, ring, worker_id)
+            persistence.refresh_bot_data(context.bot_data)
+            fetch_tweets(context)
+            persistence.update_bot_data(context.bot_data)
+        time.sleep(WORKER_HEARTBEAT_SECONDS)
+
+
+# Make the active users that hash to this worker its subscribers, with their settings and cursors as
+# stored, users that moved to another worker are dropped. The accounts that hash to this worker are polled
+# here for the active users of all workers
+def assign_users(persistence, ring, worker_id):
+    global owned_accounts
+    user_data = persistence.get_user_data()
+    users = {user_id for user_id, data in user_data.items()
+             if data.get('active', False) and ring.owner(user_id) == worker_id}
+    for user_id in list(subscribers):
+        if user_id not in users:
+            del subscribers[user_id]
+            pipeline.forget(user_id)
+    for user_id in users:
+        subscribers[user_id] = user_data[user_id]
+
+    owned = {}
+    for user_id, data in user_data.items():
+        if not data.get('active', False):
+            continue
+        for account, since_id in data['accounts'].items():
+            if ring.owner('@' + account) == worker_id:
+                oldest, replies = owned.get(account, (since_id, False))
+                owned[account] = (min(oldest, since_id), replies or data['replies'])
+    previous = owned_accounts or {}
+    # Followers further behind than the last poll, who started again, are caught up on the next cycle. The
+    # first polls of the accounts new to this worker, all of them when it starts, are spread over the polling
+    # interval
+    for account, (since_id, replies) in owned.items():
+        if account in previous and since_id < previous[account][0]:
+            scheduler.defer(account, 0)
+    scheduler.stagger(owned.keys() - previous.keys(), 60*DELAY_MINUTES)
+    persistence.drop_timelines([account for account in previous
+                                if account not in owned and ring.owner('@' + account) == worker_id])
+    owned_accounts = owned
+
+
+# Consistent hash ring of workers, when a worker joins or leaves only the users and accounts next to its points
+# move
+class HashRing:
+    def __init__(self, workers):
+        self.points = sorted((ring_hash(worker + '#' + str(i)), worker)
+                             for worker in workers for i in range(WORKER_RING_POINTS))
+        self.hashes = [point[0] for point in self.points]
+
+    # Return the worker a key belongs to, None if there are no workers
+    def owner(self, key):
+        if len(self.points) == 0:
+            return None
+        return self.points[bisect.bisect(self.hashes, ring_hash(str(key))) % len(self.points)][1]
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+# The parts of the job's CallbackContext the pipeline uses, for worker processes which have no dispatcher
+class WorkerContext:
+    def __init__(self, bot, persistence):
+        self.bot = bot
+        self.bot_data = persistence.get_bot_data()
+        self.persistence = persistence
+        # Cursors are stored through context.dispatcher.persistence
+        self.dispatcher = self
+
+
+# Map each followed account to the ids of the subscribed users following it
+def account_index():
+    index = {}
+    for user_id, user_data in list(subscribers.items()):
+        for account in list(user_data['accounts']):
+            index.setdefault(account, []).append(user_id)
+    return index
+
+
+# Fetch all new tweets for the followed accounts that are due, each account once for all users
 def fetch_tweets(context):
-    job = context.job
-
-    tweets = {}
-    for account in job.context[1].user_data['accounts']:
-        since_id = job.context[1].user_data['accounts'][account]
-        most_recent = since_id
+    pipeline.submit(context)
+
+
+# Decides when each account is polled from an estimate of its posting rate
+class Scheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (next poll, account), entries that no longer match next_poll are skipped
+        self.heap = []
+        self.next_poll = {}
+        self.last_poll = {}
+        self.intervals = {}
+        # Tweets per second
+        self.rates = {}
+
+    # Return the accounts due for polling, they are scheduled again once polled
+    def due(self, accounts):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for account in self.next_poll.keys() - accounts:
+                self.forget(account)
+            for account in accounts:
+                if account not in self.next_poll:
+                    # New account
+                    self.push(account, now, 60*DELAY_MINUTES)
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                next_poll, account = heapq.heappop(self.heap)
+                if self.next_poll.get(account) == next_poll:
+                    due.append(account)
+                    if metrics is not None:
+                        metrics.observe('twittertg_job_lag_seconds', now - next_poll)
+                    # Not scheduled while it's being polled
+                    self.next_poll[account] = None
+        return due
+
+    # Update the posting rate of a polled account and schedule its next poll, count is None if polling failed
+    def polled(self, account, count):
+        now = time.monotonic()
+        with self.lock:
+            if account not in self.next_poll:
+                return
+            interval = self.intervals[account]
+            if count is not None:
+                if account in self.last_poll:
+                    rate = count / max(now - self.last_poll[account], 1)
+                    if account in self.rates:
+                        rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rates[account]
+                    self.rates[account] = rate
+                    if rate > 0:
+                        interval = TWEETS_PER_POLL / rate
+                    else:
+                        interval = 60*MAX_DELAY_MINUTES
+                    interval = min(max(interval, 60*MIN_DELAY_MINUTES), 60*MAX_DELAY_MINUTES)
+                self.last_poll[account] = now
+            self.push(account, now + interval, interval)
+
+    # Schedule the first polls of accounts not polled yet evenly over spread seconds, in random order and
+    # with jitter, so after a restart they don't all hit the rate limit at once
+    def stagger(self, accounts, spread):
+        now = time.monotonic()
+        with self.lock:
+            accounts = [account for account in set(accounts) if account not in self.next_poll]
+            random.shuffle(accounts)
+            for i, account in enumerate(accounts):
+                self.push(account, now + (i + random.random()) * spread / len(accounts), 60*DELAY_MINUTES)
+
+    # Schedule the next poll of an account after a delay, without changing its interval
+    def defer(self, account, delay):
+        with self.lock:
+            if account in self.next_poll:
+                self.push(account, time.monotonic() + delay, self.intervals[account])
+
+    def push(self, account, next_poll, interval):
+        self.next_poll[account] = next_poll
+        self.intervals[account] = interval
+        heapq.heappush(self.heap, (next_poll, account))
+
+    def forget(self, account):
+        for state in [self.next_poll, self.last_poll, self.intervals, self.rates]:
+            state.pop(account, None)
+
+    # Return (account, seconds until the next poll, polling interval, tweets per second) in polling order
+    def schedule(self):
+        now = time.monotonic()
+        with self.lock:
+            schedule = []
+            for account, next_poll in self.next_poll.items():
+                # Accounts being polled are shown as due
+                next_poll = now if next_poll is None else next_poll
+                schedule.append((account, next_poll - now, self.intervals[account], self.rates.get(account, 0)))
+        return sorted(schedule, key=lambda entry: entry[1])
+
+
+scheduler = Scheduler()
+
+
+# Worker threads taking items from a bounded queue, a full queue blocks the stage before it
+class Stage:
+    def __init__(self, name, handler, workers, queue_size=0):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=self.name + '-' + str(i), daemon=True).start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                # The handler yields the items for the next stage
+                for result in self.handler(item):
+                    self.next.put(result)
+            except Exception:
+                logger.exception('Error in ' + self.name + ' stage')
+
+
+# One round of fetching all followed accounts
+class Cycle:
+    def __init__(self, context, index, shared=()):
+        self.context = context
+        self.index = index
+        # Accounts not polled in this cycle, read from their shared timelines, and account -> the id a shared
+        # timeline was fetched from
+        self.shared = set(shared)
+        self.since = {}
+        self.tweets = {}
+        # Accounts with more new tweets than CATCH_UP_MAX_TWEETS
+        self.truncated = set()
+        self.pending = len(index)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    # Record the tweets of a fetched account, returns True once all accounts are fetched
+    def done(self, account, tweets, truncated=False):
+        with self.lock:
+            self.tweets[account] = tweets
+            if truncated:
+                self.truncated.add(account)
+            self.pending -= 1
+            return self.pending == 0
+
+
+# Tweets flow through the stages fetch -> render -> download -> send, posts are sent to
+# each chat in tweet id order
+class Pipeline:
+    def __init__(self):
+        self.fetch = Stage('fetch', self.fetch_account, FETCH_WORKERS)
+        self.render = Stage('render', self.render_batch, RENDER_WORKERS, PIPELINE_QUEUE_SIZE)
+        self.download = Stage('download', self.download_post, MEDIA_WORKERS, PIPELINE_QUEUE_SIZE)
+        # Puts posts in chat order on the send queue, which does the sending
+        self.send = Stage('send', self.send_post, 1, PIPELINE_QUEUE_SIZE)
+        self.fetch.next = self.render
+        self.render.next = self.download
+        self.download.next = self.send
+
+        self.lock = threading.Lock()
+        self.cycle = None
+        # Per chat: next position handed out, next position to send, posts waiting for their turn
+        self.positions = {}
+        self.next_position = {}
+        self.waiting = {}
+        self.chat_locks = {}
+        # (user id, account) -> newest tweet handed out, cursors only move once tweets are sent
+        self.dispatched = {}
+        # (chat id, account) -> ids of the tweets handed out and not yet sent or given up on
+        self.in_flight = {}
+        # Number of merges so far, and (chat id, account) -> [cursor, merges at the time, ids sent since] for chats
+        # where a post failed, the cursor stays before the post's tweets until a later merge hands them out again.
+        # Tweets sent after it or still in flight aren't handed out twice
+        self.merges = 0
+        self.held = {}
+
+    def start(self):
+        for stage in [self.fetch, self.render, self.download, self.send]:
+            stage.start()
+
+    # Start a fetch cycle unless the previous one is still held up
+    def submit(self, context):
+        with self.lock:
+            if self.cycle is not None:
+                logger.warning('Previous fetch cycle still running, skipping')
+                return
+            index = account_index()
+            shared = {}
+            if owned_accounts is None:
+                index = {account: index[account] for account in scheduler.due(index.keys())}
+            else:
+                # Poll the accounts this worker owns when they're due, for all workers, and read the tweets of
+                # the other followed accounts from their shared timelines
+                due = {account: index.get(account, []) for account in scheduler.due(owned_accounts.keys())}
+                shared = {account: user_ids for account, user_ids in index.items() if account not in due}
+                index = due
+                index.update(shared)
+            if len(index) == 0:
+                return
+            self.cycle = Cycle(context, index, shared)
+            cycle = self.cycle
+        for account in index:
+            self.fetch.put((cycle, account))
+
+    # Return the newest tweet of an account handed out to a user
+    def since(self, user_id, account, user_data):
+        return max(user_data['accounts'][account], self.dispatched.get((user_id, account), 0))
+
+    def fetch_account(self, item):
+        cycle, account = item
+        users = [(user_id, subscribers[user_id]) for user_id in cycle.index[account]
+                 if user_id in subscribers]
+        tweets = []
+        truncated = False
         try:
-            recent_tweets = get_tweets_since(account, since_id, job.context[1].user_data['replies'])
-            for tweet in recent_tweets:
-                tweets[tweet.id] = tweet
-                if tweet.id > most_recent:
-                    most_recent = tweet.id
-            job.context[1].user_data['accounts'][account] = most_recent
+            if account in cycle.shared:
+                since_id = min(self.since(user_id, account, user_data) for user_id, user_data in users)
+                tweets, truncated, cycle.since[account] = cycle.context.persistence.read_timeline(account, since_id)
+            else:
+                if owned_accounts is None:
+                    # Fetch from the oldest tweet any subscriber still needs
+                    since_id = min(self.since(user_id, account, user_data) for user_id, user_data in users)
+                    include_replies = any(user_data['replies'] for user_id, user_data in users)
+                else:
+                    # Fetch from the oldest tweet any follower on any worker still needs
+                    since_id, include_replies = owned_accounts[account]
+                tweets = get_tweets_since(account, since_id, include_replies, CATCH_UP_MAX_TWEETS + 1)
+                if len(tweets) > CATCH_UP_MAX_TWEETS:
+                    tweets = tweets[:CATCH_UP_MAX_TWEETS]
+                    truncated = True
+                if owned_accounts is not None:
+                    cycle.context.persistence.store_timeline(account, since_id, tweets, truncated)
+                scheduler.polled(account, len(tweets))
+        except tweepy.RateLimitError as e:
+            # Poll again once there is budget
+            logger.warning('RateLimitError: ' + str(e) + ' - deferring account: @' + account)
+            scheduler.defer(account, rate_limits.wait('statuses/user_timeline'))
         except tweepy.TweepError as e:
             logger.error('TweepError: ' + str(e) + ' - while fetching account: @' + account)
-
-    for id in sorted(tweets):
-        try:
-            post_tweet(job.context[0], job.context[1], tweets[id])
-        except tweepy.TweepError as e:
-            logger.error('TweepError: ' + str(e) + ' - for tweet: https://twitter.com/' +
-                         tweets[id].user.screen_name + '/status/' + str(tweets[id].id))
-        except Exception as e:
-            raise e
+            scheduler.polled(account, None)
+        except (ValueError, KeyError):
+            # Unsubscribed or unfollowed in the meantime
+            scheduler.polled(account, None)
+        except Exception:
+            # The account is polled again and the cycle finishes without its tweets
+            logger.exception('Error while fetching account: @' + account)
+            scheduler.polled(account, None)
+        if cycle.done(account, tweets, truncated):
+            try:
+                batch = self.merge(cycle)
+                if metrics is not None:
+                    metrics.observe('twittertg_fetch_cycle_seconds', time.perf_counter() - cycle.started)
+                yield (cycle.context, batch)
+            finally:
+                # Rendering accepted the batch or the cycle failed, the next cycle may start
+                with self.lock:
+                    self.cycle = None
+
+    # Hand out the fetched tweets according to each subscriber's own cursor, returns a list of
+    # (tweets, chat id -> position, chat id -> checkpoint, message) in id order, tweets is a thread of
+    # self-replies or a single tweet, message is set for notes about skipped tweets
+    def merge(self, cycle):
+        chats = {}
+        checkpoints = {}
+        skipped = {}
+        # Failed posts roll back what was handed out under the lock, so a failure either happens before this
+        # merge and its tweets are handed out again, or after and holds back this merge's cursors too
+        with self.lock:
+            self.merges += 1
+            for account, user_ids in cycle.index.items():
+                tweets = cycle.tweets[account]
+                for user_id in user_ids:
+                    if user_id not in subscribers:
+                        continue
+                    user_data = subscribers[user_id]
+                    if account not in user_data['accounts']:
+                        continue
+                    user_since_id = self.since(user_id, account, user_data)
+                    if user_since_id < cycle.since.get(account, 0):
+                        # The shared timeline doesn't go back that far yet, the worker polling the account
+                        # fetches from this user's cursor on its next cycle
+                        continue
+                    most_recent = user_since_id
+                    last = None
+                    key = (user_id, account)
+                    in_flight = self.in_flight.setdefault(key, set())
+                    sent = self.held[key][2] if key in self.held else ()
+                    # Timelines are newest first
+                    for tweet in reversed(tweets):
+                        if tweet.id <= user_since_id:
+                            continue
+                        most_recent = tweet.id
+                        if (tweet.in_reply_to_status_id is not None and not user_data['replies']) or \
+                                tweet.id in sent or tweet.id in in_flight:
+                            continue
+                        chats.setdefault(tweet.id, set()).add(user_id)
+                        in_flight.add(tweet.id)
+                        checkpoints.setdefault(tweet.id, {})[user_id] = (account, tweet.id, self.merges)
+                        last = tweet.id
+                    if last is not None:
+                        # Sending the last tweet also moves the cursor past the replies left out after it
+                        checkpoints[last][user_id] = (account, most_recent, self.merges)
+                        if account in cycle.truncated and tweets[-1].id > user_since_id:
+                            skipped.setdefault(account, set()).add(user_id)
+                    self.dispatched[(user_id, account)] = most_recent
+
+        entries = []
+        for account, user_ids in sorted(skipped.items()):
+            message = 'Skipped older tweets from @' + account + ' while catching up, the latest ' + \
+                      str(CATCH_UP_MAX_TWEETS) + ' follow.'
+            entries.append(([cycle.tweets[account][-1]], user_ids, {}, message))
+        # Merge the timelines oldest first
+        timelines = [reversed(tweets) for tweets in cycle.tweets.values()]
+        # Screen name -> the account's last entry, which self-replies going to the same chats continue
+        threads = {}
+        for tweet in heapq.merge(*timelines, key=lambda tweet: tweet.id):
+            if tweet.id not in chats:
+                continue
+            tweet_chats = chats.pop(tweet.id)
+            entry = threads.get(tweet.screen_name)
+            if COALESCE_THREADS and entry is not None and entry[1] == tweet_chats and continues(entry[0][-1], tweet):
+                entry[0].append(tweet)
+                # The later tweet's checkpoints are further along
+                entry[2].update(checkpoints[tweet.id])
+            else:
+                entry = ([tweet], tweet_chats, checkpoints[tweet.id], None)
+                entries.append(entry)
+            threads[tweet.screen_name] = entry
+
+        batch = []
+        with self.lock:
+            for statuses, user_ids, checkpoints, message in entries:
+                positions = {}
+                for chat_id in sorted(user_ids):
+                    positions[chat_id] = self.positions.get(chat_id, 0)
+                    self.positions[chat_id] = positions[chat_id] + 1
+                batch.append((statuses, positions, checkpoints, message))
+        return batch
+
+    def render_batch(self, item):
+        context, batch = item
+        # Fetch the replied tweets of the whole batch up front, except those in the batch
+        in_batch = {status.id: status for statuses, positions, checkpoints, message in batch for status in statuses}
+        parents = hydrate([status for status in in_batch.values() if status.in_reply_to_status_id not in in_batch])
+        parents.update(in_batch)
+        logger.info('Tweet cache: ' + status_cache.stats())
+        for statuses, positions, checkpoints, message in batch:
+            try:
+                if message is not None:
+                    post = Post(statuses[0], message)
+                else:
+                    post = render_thread(statuses, parents)
+            except Exception as e:
+                post = Post(statuses[0])
+                post.error = e
+                logger.error(type(e).__name__ + ': ' + str(e) + ' - for tweet: ' + post.url)
+            post.context = context
+            post.chats = positions
+            post.checkpoints = checkpoints
+            post.pending = len(positions)
+            yield post
+
+    def download_post(self, post):
+        if post.error is None:
+            try:
+                download_media(post.context, post)
+            except Exception as e:
+                post.error = e
+                logger.error(type(e).__name__ + ': ' + str(e) + ' - while downloading: ' + post.url)
+        yield post
+
+    # Queue the post in each of its chats and send whatever is next in line
+    def send_post(self, post):
+        for chat_id, position in post.chats.items():
+            with self.lock:
+                heapq.heappush(self.waiting.setdefault(chat_id, []), (position, post.id, post))
+                chat_lock = self.chat_locks.setdefault(chat_id, threading.Lock())
+            # One thread at a time sends to a chat
+            with chat_lock:
+                while True:
+                    with self.lock:
+                        waiting = self.waiting[chat_id]
+                        if len(waiting) == 0 or waiting[0][0] != self.next_position.get(chat_id, 0):
+                            break
+                        position, id, next_post = heapq.heappop(waiting)
+                        self.next_position[chat_id] = position + 1
+                    self.deliver(chat_id, next_post)
+        return []
+
+    def deliver(self, chat_id, post):
+        if post.error is not None or chat_id not in subscribers:
+            self.delivered(chat_id, post, post.error)
+            return
+        futures = queue_post(post.context, chat_id, post)
+        futures[-1].add_done_callback(lambda future: self.delivered(chat_id, post, send_error(futures)))
+
+    # Move the chat's cursor past a post it's done with and store it, sends to a chat finish in order
+    # so everything before the post was sent too. A post that failed with an error a later attempt may get
+    # past holds the chat's cursor before its tweets, which are fetched again
+    def delivered(self, chat_id, post, error=None):
+        if chat_id in post.checkpoints:
+            with self.lock:
+                self.in_flight.get((chat_id, post.checkpoints[chat_id][0]), set()).difference_update(post.tweet_ids)
+        if chat_id in post.checkpoints and chat_id in subscribers:
+            account, since_id, merge = post.checkpoints[chat_id]
+            key = (chat_id, account)
+            with self.lock:
+                if error is not None and transient(error):
+                    cursor = min(post.tweet_ids) - 1
+                    sent = set()
+                    if key in self.held:
+                        cursor = min(cursor, self.held[key][0])
+                        sent = self.held[key][2]
+                    self.held[key] = [cursor, self.merges, sent]
+                    self.dispatched[key] = min(self.dispatched.get(key, cursor), cursor)
+                    logger.warning('Sending again on the next cycle: ' + post.url)
+                elif key in self.held and merge > self.held[key][1]:
+                    # Handed out again after the failure
+                    del self.held[key]
+                elif key in self.held:
+                    self.held[key][2].update(post.tweet_ids)
+                if key in self.held:
+                    since_id = min(since_id, self.held[key][0])
+            user_data = subscribers[chat_id]
+            if user_data['accounts'].get(account, since_id) < since_id:
+                user_data['accounts'][account] = since_id
+                persistence = post.context.dispatcher.persistence
+                if persistence is not None:
+                    persistence.update_since_id(chat_id, account, since_id)
+        self.sent(post)
+
+    # Drop what was handed out to a user that moved to another worker, which resumes from the stored cursors
+    def forget(self, user_id):
+        with self.lock:
+            for state in [self.dispatched, self.in_flight, self.held]:
+                for key in [key for key in state if key[0] == user_id]:
+                    del state[key]
+
+    # Delete the media of a post once it's been sent to all its chats
+    def sent(self, post):
+        with self.lock:
+            post.pending -= 1
+            sent = post.pending == 0
+        if sent:
+            release_media(post)
+
+
+pipeline = Pipeline()
+
+
+# The fields of a tweet the bot uses, built from a tweepy Status when it's fetched so the rest of the
+# Status isn't kept around
+class Tweet:
+    __slots__ = ['id', 'screen_name', 'name', 'full_text', 'text_start', 'links', 'in_reply_to_status_id',
+                 'in_reply_to_screen_name', 'image_urls', 'video_info', 'quoted_status', 'retweeted_status']
+
+    def __init__(self, status):
+        self.id = status.id
+        self.screen_name = status.user.screen_name
+        self.name = status.user.name
+        self.full_text = status.full_text
+        # Where the text starts after the leading mentions of a reply
+        self.text_start = status.display_text_range[0] if hasattr(status, 'display_text_range') else 0
+        self.links = tweet_links(status)
+        self.in_reply_to_status_id = status.in_reply_to_status_id
+        self.in_reply_to_screen_name = status.in_reply_to_screen_name
+        self.image_urls = ()
+        # The MP4 variants and duration of the video or GIF
+        self.video_info = None
+        if hasattr(status, 'extended_entities'):
+            self.image_urls = tuple(media['media_url'] for media in status.extended_entities.get('media', [])
+                                    if media.get('type', None) == 'photo')
+            for media in status.extended_entities.get('media', []):
+                if media.get('type', None) == 'video' or media.get('type', None) == 'animated_gif':
+                    video_info = media.get('video_info', {})
+                    self.video_info = {'duration_millis': video_info.get('duration_millis', 0),
+                                       'variants': video_variants(video_info)}
+                    break
+        self.quoted_status = Tweet(status.quoted_status) if hasattr(status, 'quoted_status') else None
+        self.retweeted_status = Tweet(status.retweeted_status) if hasattr(status, 'retweeted_status') else None
+
+
+# Return the links in the text of a tweet as (index, t.co URL, replacement) in text order: links are
+# expanded, the link to the media and the link to a quoted tweet are removed
+def tweet_links(status):
+    quote_url = None
+    if hasattr(status, 'quoted_status_permalink'):
+        quote_url = status.quoted_status_permalink['expanded']
+    links = []
+    for entity in status.entities.get('urls', []):
+        replacement = ''
+        if entity['expanded_url'] != quote_url:
+            replacement = html.escape(entity['expanded_url'], quote=False)
+        links.append((entity['indices'][0], entity['url'], replacement))
+    # All media of a tweet share one link
+    for entity in status.entities.get('media', [])[:1]:
+        links.append((entity['indices'][0], entity['url'], ''))
+    return tuple(sorted(links))
 
 
 # Check if a tweet contains media
 def has_media(status):
-    return hasattr(status, 'extended_entities') and 'media' in status.extended_entities
+    return len(status.image_urls) > 0 or status.video_info is not None
 
 
 # Initialize user data
@@ -404,119 +1842,473 @@ def init_user_data(context):
         context.user_data['replies'] = True
 
 
-# Return a list of filenames of images, check if tweet contains media before calling
+# Return a list of image URLs
 def images(status):
-    image_urls = []
-    for media in status.extended_entities.get('media', [{}]):
-        if media.get('type', None) == 'photo':
-            image_urls.append(media['media_url'])
-    return image_urls
+    return list(status.image_urls)
 
 
-# Return a URL for video, or '' if no video, check if tweet contains media before calling
+# Return a URL for video, or '' if no video
 def video(status):
-    for media in status.extended_entities.get('media', [{}]):
-        if media.get('type', None) == 'video' or media.get('type', None) == 'animated_gif':
-            return 'https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id)
-    return ''
-
-
-# Expand URLs in the text
-def expand_urls(status, message):
-    if hasattr(status, 'retweeted_status'):
-        # Expand links in retweeted message
-        status = status.retweeted_status
-    if 'urls' in status.entities:
-        for embedded_url in status.entities.get('urls', [{}]):
-            message = message.replace(embedded_url['url'], embedded_url['expanded_url'])
-        return message
+    if status.video_info is None:
+        return ''
+    return 'https://twitter.com/' + status.screen_name + '/status/' + str(status.id)
 
 
 # Return the id in a tweet URL
 def id_from_url(url):
     if '?' in url:
         url = url.split('?')[0]
+    if '/status/' in url:
+        # Links to a tweet's photos or video have more after the id
+        return int(url.split('/status/')[1].split('/')[0])
     return int(url.split('/')[-1])
 
 
 # Fetch the most recent tweet
 def get_last_tweet(username):
-    status = api.user_timeline(screen_name=username, count=1, include_rts=1, tweet_mode='extended')[0]
+    status = call_api('statuses/user_timeline', 'user_timeline', screen_name=username, count=1, include_rts=1,
+                      tweet_mode='extended')[0]
     return status.id
 
 
 # Fetch a tweet with a particular id
+@timed
 def get_tweet(id):
-    status = api.get_status(id, tweet_mode='extended')
+    status = status_cache.get(id)
+    if status is None:
+        status = Tweet(call_api('statuses/show', 'get_status', id, tweet_mode='extended'))
+        status_cache.put(id, status)
     return status
 
 
-# Fetch all tweets newer than a particular id
-def get_tweets_since(account, id, include_replies):
-    tweets = []
+# Fetch tweets by id in batches, returns a dict of id to tweet, missing tweets are left out
+@timed
+def get_tweets(ids):
+    statuses = {}
+    missing = []
+    for id in ids:
+        status = status_cache.get(id)
+        if status is None:
+            missing.append(id)
+        else:
+            statuses[id] = status
+    for i in range(0, len(missing), LOOKUP_BATCH_SIZE):
+        for status in call_api('statuses/lookup', 'statuses_lookup', missing[i:i + LOOKUP_BATCH_SIZE],
+                               tweet_mode='extended'):
+            status = Tweet(status)
+            statuses[status.id] = status
+            status_cache.put(status.id, status)
+    return statuses
+
+
+# Fetch the replied tweets needed to post a list of tweets, returns a dict of id to tweet
+def hydrate(statuses):
+    ids = set()
+    for status in statuses:
+        if status.in_reply_to_status_id is not None:
+            ids.add(status.in_reply_to_status_id)
+    try:
+        return get_tweets(sorted(ids))
+    except tweepy.TweepError as e:
+        # post_tweet falls back to fetching the replied tweets one by one
+        logger.error('TweepError: ' + str(e) + ' - while fetching replied tweets')
+        return {}
+
+
+# Iterate over the tweets newer than a particular id, newest first, fetching a page at a time
+def iter_tweets_since(account, id, include_replies):
     exclude = not include_replies
-    for status in tweepy.Cursor(api.user_timeline, screen_name=account,
-                                tweet_mode='extended', since_id=id, exclude_replies=exclude).items():
-        tweets.append(status)
-    return tweets
+    max_id = None
+    while True:
+        page = call_api('statuses/user_timeline', 'user_timeline', screen_name=account, count=200,
+                        tweet_mode='extended', since_id=id, max_id=max_id, exclude_replies=exclude)
+        if len(page) == 0:
+            return
+        max_id = page[-1].id - 1
+        for status in page:
+            tweet = Tweet(status)
+            # Later tweets of a thread reply to this one
+            status_cache.put(tweet.id, tweet)
+            yield tweet
+
+
+# Fetch the tweets newer than a particular id, newest first, at most limit of them
+@timed
+def get_tweets_since(account, id, include_replies, limit=None):
+    return list(itertools.islice(iter_tweets_since(account, id, include_replies), limit))
+
+
+# Return the Twitter API object of the current thread
+def twitter():
+    global auth
+    if not hasattr(apis, 'api'):
+        if auth is None:
+            auth = tweepy.AppAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
+        apis.api = tweepy.API(auth)
+    return apis.api
+
+
+# Call a Twitter API method, spending from the rate limit budget of its endpoint
+def call_api(endpoint, method, *args, **kwargs):
+    if not rate_limits.acquire(endpoint):
+        raise tweepy.RateLimitError('Rate limit budget spent: ' + endpoint)
+    api = twitter()
+    api.last_response = None
+    try:
+        return getattr(api, method)(*args, **kwargs)
+    finally:
+        if api.last_response is not None:
+            rate_limits.update(endpoint, api.last_response.headers)
+
+
+# Hands out Twitter API calls per endpoint from token buckets refilled over the rate limit window,
+# capped by what Twitter reports as remaining
+class RateLimits:
+    # share is the part of the limits this process may use
+    def __init__(self, limits, share=1):
+        self.lock = threading.Lock()
+        self.share = share
+        self.limits = {endpoint: limit * share for endpoint, limit in limits.items()}
+        self.tokens = dict(self.limits)
+        self.refilled = {}
+        # From the x-rate-limit-remaining and x-rate-limit-reset headers
+        self.remaining = {}
+        self.resets = {}
+
+    def refill(self, endpoint, now):
+        limit = self.limits.setdefault(endpoint, min(self.limits.values()))
+        elapsed = now - self.refilled.get(endpoint, now)
+        self.tokens[endpoint] = min(limit, self.tokens.get(endpoint, limit) +
+                                    elapsed * limit / (60*RATE_LIMIT_WINDOW_MINUTES))
+        self.refilled[endpoint] = now
+        if self.resets.get(endpoint, 0) <= now:
+            # New window
+            self.remaining.pop(endpoint, None)
+
+    # Take a call from the budget, returns False if none is left
+    def acquire(self, endpoint):
+        with self.lock:
+            self.refill(endpoint, time.time())
+            if self.tokens[endpoint] < 1 or self.remaining.get(endpoint, 1) < 1:
+                return False
+            self.tokens[endpoint] -= 1
+            if endpoint in self.remaining:
+                self.remaining[endpoint] -= 1
+            return True
+
+    def update(self, endpoint, headers):
+        with self.lock:
+            if 'x-rate-limit-limit' in headers:
+                self.limits[endpoint] = int(headers['x-rate-limit-limit']) * self.share
+            if 'x-rate-limit-reset' in headers:
+                self.resets[endpoint] = int(headers['x-rate-limit-reset'])
+            if 'x-rate-limit-remaining' in headers:
+                self.remaining[endpoint] = int(headers['x-rate-limit-remaining'])
+                self.tokens[endpoint] = min(self.tokens.get(endpoint, 0), self.remaining[endpoint])
+
+    # Return the number of seconds until a call is available
+    def wait(self, endpoint):
+        with self.lock:
+            now = time.time()
+            self.refill(endpoint, now)
+            if self.remaining.get(endpoint, 1) < 1:
+                return max(self.resets[endpoint] - now, 1)
+            return max((1 - self.tokens[endpoint]) * 60*RATE_LIMIT_WINDOW_MINUTES / self.limits[endpoint], 0)
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            lines = []
+            for endpoint in sorted(self.limits):
+                self.refill(endpoint, now)
+                line = endpoint + ': ' + str(int(self.tokens[endpoint])) + '/' + str(round(self.limits[endpoint]))
+                if endpoint in self.remaining:
+                    line += ', ' + str(self.remaining[endpoint]) + ' left until reset in ' + \
+                            str(round((self.resets[endpoint] - now) / 60)) + ' min'
+                lines.append(line)
+            return '\n'.join(lines)
+
+
+rate_limits = RateLimits(RATE_LIMITS)
+
+
+# Sends to Telegram in order per chat within the flood limits, waiting out RetryAfter and retrying
+# network errors
+class SendQueue:
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.size = 0
+        self.condition = threading.Condition()
+        # Chat id -> deque of [send, cost, description, future, time queued, attempts]
+        self.chats = {}
+        # (time a chat may send, chat id) for chats with queued sends that are not in flight
+        self.ready = []
+        # Theoretical arrival times of the flood limits (GCRA)
+        self.chat_tats = {}
+        self.global_tat = 0
+        self.latencies = deque(maxlen=1000)
+        self.retries = 0
+        self.failures = 0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name='send-' + str(i), daemon=True).start()
+
+    # Queue a send for a chat, blocks while the queue is full, returns a Future of the send's result
+    def put(self, chat_id, send, cost=1, description=''):
+        future = Future()
+        with self.condition:
+            while self.size >= self.maxsize:
+                self.condition.wait()
+            self.size += 1
+            sends = self.chats.setdefault(chat_id, deque())
+            sends.append([send, cost, description, future, time.monotonic(), 0])
+            if len(sends) == 1:
+                self.schedule(chat_id, time.monotonic())
+            self.condition.notify_all()
+        return future
+
+    def schedule(self, chat_id, not_before):
+        tolerance = (CHAT_SEND_BURST - 1) / CHAT_SENDS_PER_SECOND
+        heapq.heappush(self.ready, (max(not_before, self.chat_tats.get(chat_id, 0) - tolerance), chat_id))
+
+    # Wait for the next chat that may send within the flood limits
+    def next(self):
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if len(self.ready) > 0:
+                global_ready = self.global_tat - (GLOBAL_SEND_BURST - 1) / GLOBAL_SENDS_PER_SECOND
+                timeout = max(self.ready[0][0], global_ready) - now
+                if timeout <= 0:
+                    chat_id = heapq.heappop(self.ready)[1]
+                    job = self.chats[chat_id][0]
+                    self.global_tat = max(self.global_tat, now) + job[1] / GLOBAL_SENDS_PER_SECOND
+                    self.chat_tats[chat_id] = max(self.chat_tats.get(chat_id, 0), now) + \
+                        job[1] / CHAT_SENDS_PER_SECOND
+                    return chat_id, job
+            self.condition.wait(timeout)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                chat_id, job = self.next()
+            send, cost, description, future, queued, attempts = job
+            result = error = None
+            try:
+                result = send()
+            except Exception as e:
+                error = e
+
+            finished = False
+            with self.condition:
+                now = time.monotonic()
+                if isinstance(error, RetryAfter):
+                    # Flood limit hit anyway, the chat waits as long as Telegram asks
+                    logger.warning('RetryAfter ' + str(error.retry_after) + 's: ' + description)
+                    self.retries += 1
+                    self.schedule(chat_id, now + error.retry_after)
+                elif isinstance(error, NetworkError) and not isinstance(error, (BadRequest, TimedOut)) and \
+                        attempts < SEND_RETRIES:
+                    # A send that timed out may have been posted anyway, so it isn't tried again
+                    logger.warning(type(error).__name__ + ', trying again: ' + description)
+                    self.retries += 1
+                    job[5] += 1
+                    self.schedule(chat_id, now + SEND_RETRY_DELAY * 2 ** attempts)
+                else:
+                    finished = True
+                    sends = self.chats[chat_id]
+                    sends.popleft()
+                    if len(sends) == 0:
+                        del self.chats[chat_id]
+                    else:
+                        self.schedule(chat_id, now)
+                    self.size -= 1
+                    self.latencies.append(now - queued)
+                    if error is not None:
+                        self.failures += 1
+                        logger.error(type(error).__name__ + ': ' + str(error) + ' - while sending: ' + description)
+                self.condition.notify_all()
+            if finished:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def stats(self):
+        with self.condition:
+            latencies = sorted(self.latencies)
+            size = self.size
+            chats = len(self.chats)
+        line = 'depth ' + str(size) + ' in ' + str(chats) + ' chats, retries ' + str(self.retries) + \
+               ', failures ' + str(self.failures)
+        if len(latencies) > 0:
+            line += ', latency p50 ' + str(round(latencies[len(latencies) // 2] * 1000)) + ' ms, p99 ' + \
+                    str(round(latencies[int(len(latencies) * 0.99)] * 1000)) + ' ms'
+        return line
+
+
+send_queue = SendQueue(SEND_WORKERS, PIPELINE_QUEUE_SIZE)
+
+
+# Whether an error fetching, downloading or sending may be gone on a later attempt, Telegram rejecting a post
+# or a bug rendering it won't be, and a send that timed out may have been posted
+def transient(error):
+    if isinstance(error, (BadRequest, TimedOut)):
+        return False
+    if isinstance(error, tweepy.TweepError):
+        # Rate limits, Twitter's server errors and failed connections, not tweets that are gone or refused
+        return isinstance(error, tweepy.RateLimitError) or error.response is None or \
+            error.response.status_code >= 500
+    return isinstance(error, (NetworkError, requests.RequestException, OSError))
 
 
 # Send a post with text only to the bot
-def send_text_post(update, context, message):
-    context.bot.send_message(chat_id=update.message.from_user['id'], text=message,
-                                 parse_mode='HTML', disable_web_page_preview=True)
+@timed
+def send_text_post(context, chat_id, message):
+    return context.bot.send_message(chat_id=chat_id, text=message,
+                                    parse_mode='HTML', disable_web_page_preview=True)
 
 
-# Send a post with one image to the bot
-def send_image_post(update, context, message, filename):
-    context.bot.send_photo(chat_id=update.message.from_user['id'], photo=open(filename, 'rb'),
-                                caption=message, parse_mode='HTML')
+# Send a post with one image to the bot, photo is a file or a Telegram file_id
+@timed
+def send_image_post(context, chat_id, message, photo):
+    return context.bot.send_photo(chat_id=chat_id, photo=photo,
+                                  caption=message, parse_mode='HTML')
 
 
-# Send a post with multiple images to the bot
-def send_gallery_post(update, context, message, filenames):
+# Send a post with multiple images to the bot, photos are files or Telegram file_ids
+@timed
+def send_gallery_post(context, chat_id, message, photos):
     group = []
     # Put caption on the first image or it won't show
-    first_filename = filenames.pop(0)
-    group.append(InputMediaPhoto(open(first_filename, 'rb'), caption=message, parse_mode='HTML'))
-    for filename in filenames:
-        group.append(InputMediaPhoto(open(filename, 'rb')))
-    filenames.append(first_filename)
-    context.bot.send_media_group(chat_id=update.message.from_user['id'], media=group)
+    group.append(InputMediaPhoto(photos[0], caption=message, parse_mode='HTML'))
+    for photo in photos[1:]:
+        group.append(InputMediaPhoto(photo))
+    return context.bot.send_media_group(chat_id=chat_id, media=group)
 
 
-# Send a post with a video file to the bot
-def send_video_post(update, context, message, filename):
-    return context.bot.send_video(chat_id=update.message.from_user['id'], video=open(filename, 'rb'),
-                               caption=message, parse_mode='HTML')
+# Send a post with a video to the bot, video is a file or a Telegram file_id
+@timed
+def send_video_post(context, chat_id, message, video):
+    return context.bot.send_video(chat_id=chat_id, video=video,
+                                  caption=message, parse_mode='HTML')
 
 
-# Takes a list of image URLs, downloads the images and returns the filenames
+# Takes a list of image URLs, downloads the images in parallel and returns their buffers
+@timed
 def save_images(image_urls):
-    filenames = []
-    for image_url in image_urls:
-        filename = './media/' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=15))
-        filenames.append(filename)
-        r = requests.get(image_url, stream=True)
-        if r.status_code == 200:
-            r.raw.decode_content = True
-            with open(filename, 'wb') as f:
+    futures = [download_pool.submit(save_image, image_url) for image_url in image_urls]
+    try:
+        return [future.result() for future in futures]
+    except Exception:
+        # Don't leave the other downloads open
+        for future in futures:
+            if future.exception() is None:
+                future.result().close()
+        raise
+
+
+# Takes an image URL, downloads the image and returns a buffer of it
+def save_image(image_url):
+    start = time.perf_counter()
+    f = MediaBuffer(image_url.rsplit('/', 1)[-1])
+    try:
+        with session.get(image_url, stream=True) as r:
+            if r.status_code == 200:
+                r.raw.decode_content = True
                 shutil.copyfileobj(r.raw, f)
-    return filenames
+                if metrics is not None:
+                    metrics.inc('twittertg_downloaded_bytes_total', f.tell())
+            else:
+                logger.error('HTTP ' + str(r.status_code) + ' while downloading: ' + image_url)
+    except Exception:
+        f.close()
+        raise
+    logger.info('Downloaded ' + image_url + ' in ' + str(round((time.perf_counter() - start) * 1000)) + ' ms')
+    return f
+
+
+# Takes a video URL and its video_info, downloads the video and returns a buffer of it, None if it couldn't be
+# downloaded
+@timed
+def save_video(video_url, video_info, filename):
+    variants = [] if video_info is None else video_variants(video_info)
+    if len(variants) == 0:
+        # No MP4 to pick from
+        return save_video_youtube_dl(video_url, filename)
+    duration = video_info.get('duration_millis', 0) / 1000
+    for variant in variants:
+        # Skip variants expected to be too large to upload
+        if variant.get('bitrate', 0) / 8 * duration > VIDEO_MAX_BYTES:
+            continue
+        f = MediaBuffer(filename + '.mp4')
+        try:
+            if save_video_variant(variant['url'], f):
+                return f
+        except Exception:
+            f.close()
+            raise
+        f.close()
+    logger.error('No video under ' + str(round(VIDEO_MAX_BYTES / (1024*1024))) + ' MB: ' + video_url)
+    return None
+
+
+# Return the MP4 variants of a video from the highest to the lowest bitrate
+def video_variants(video_info):
+    variants = [variant for variant in video_info.get('variants', [])
+                if variant.get('content_type') == 'video/mp4' and 'url' in variant]
+    return sorted(variants, key=lambda variant: variant.get('bitrate', 0), reverse=True)
+
+
+# Streams a video file into a buffer, returns False if the download failed or was larger than Telegram accepts
+def save_video_variant(url, f):
+    size = 0
+    with session.get(url, stream=True) as r:
+        if r.status_code != 200:
+            logger.error('HTTP ' + str(r.status_code) + ' while downloading: ' + url)
+            return False
+        if int(r.headers.get('Content-Length', 0)) > VIDEO_MAX_BYTES:
+            return False
+        for chunk in r.iter_content(VIDEO_CHUNK_SIZE):
+            size += len(chunk)
+            if size > VIDEO_MAX_BYTES:
+                return False
+            f.write(chunk)
+    return True
+
+
+# Takes a tweet URL, downloads its video with youtube_dl and returns the file opened for reading, None if
+# there is no MP4
+def save_video_youtube_dl(video_url, filename):
+    ydl_opts = {'outtmpl': './media/' + filename + '.%(ext)s', 'quiet': True}
+    try:
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([video_url])
+        if not os.path.exists('./media/' + filename + '.mp4'):
+            logger.error('File extension error: ' + filename)
+            return None
+        # The open file stays readable after it's removed
+        return open('./media/' + filename + '.mp4', 'rb')
+    finally:
+        for name in os.listdir('./media'):
+            if name.startswith(filename + '.'):
+                os.remove('./media/' + name)
 
 
-# Takes a video URL, downloads the video and returns the filename
-def save_video(video_url, filename):
-    ydl_opts = {'outtmpl': './media/' + filename + '.%(ext)s', 'quiet': True}
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([video_url])
-    return './media/' + filename
+# Remove files left in ./media/ by a previous run
+def sweep_media():
+    os.makedirs('./media', exist_ok=True)
+    for name in os.listdir('./media'):
+        if name != '.gitignore' and os.path.isfile('./media/' + name):
+            os.remove('./media/' + name)
 
 
 # Returns a link to a Twitter post, with context if needed
 def link_to_tweet(status, is_reply=False, is_self_reply=False):
-    url = 'https://twitter.com/' + status.user.screen_name + '/status/' + str(status.id)
-    link = '<a href="' + url + '">' + status.user.name + ' (@' + status.user.screen_name + ')' + '</a>'
+    url = 'https://twitter.com/' + status.screen_name + '/status/' + str(status.id)
+    link = '<a href="' + url + '">' + html.escape(status.name, quote=False) + ' (@' + status.screen_name + ')' + '</a>'
     if is_reply or is_self_reply:
         if is_self_reply:
             link += ' continued:'